@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""Check the alembic migrations against a populated database.
+
+For a database with unique Galaxy ids and one holding duplicate rows from concurrent runs, this builds a SQLite
+database at the first revision (1c2fa871bb2b) with a few rows, upgrades it to head, checks the lookup indexes
+(ix_history_table_id and ix_user_table_id fall back to non-unique when there are duplicates) and that no rows were
+lost, then downgrades it to the first revision again and checks the indexes are gone.
+
+Example:
+  python alembic/check_migrations.py
+"""
+import os, shutil, sys, tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+import models  # env.py imports models; load it from this checkout whatever the working directory
+import sqlalchemy as sa
+from alembic import command
+from alembic.config import Config
+
+FIRST_REVISION = '1c2fa871bb2b'
+ID_INDEXES = {'history_table': 'ix_history_table_id', 'user_table': 'ix_user_table_id'}
+LOOKUP_INDEXES = {
+    'history_table': ['ix_history_table_sync_id'],
+    'history_notification_table': ['ix_history_notification_table_history_id_h_date', 'ix_history_notification_table_notification_id'],
+    'notification_table': ['ix_notification_table_type'],
+}
+TABLES = ['message_table', 'user_table', 'history_table', 'notification_table', 'history_notification_table']
+
+
+def populate(engine, duplicates):
+    with engine.begin() as connection:
+        connection.execute(sa.text("INSERT INTO message_table (id, message_id, status) VALUES (1, 101, 'success')"))
+        users = ['u1', 'u2'] + (['u1'] if duplicates else [])
+        for uid, user_id in enumerate(users, 1):
+            connection.execute(sa.text(
+                "INSERT INTO user_table (uid, nice_total_disk_usage, username, is_admin, quota_percent, total_disk_usage, "
+                "purged, quota, email, id, deleted) VALUES (:uid, '1 KB', :name, 0, 0.5, 1.0, 0, 'unlimited', :email, :id, 0)"),
+                dict(uid=uid, name='user' + user_id, email=user_id + '@example.org', id=user_id))
+        histories = ['h1', 'h2', 'h3'] + (['h2'] if duplicates else [])
+        for hid, history_id in enumerate(histories, 1):
+            connection.execute(sa.text(
+                "INSERT INTO history_table (hid, update_time, size, name, id, user_id, status) "
+                "VALUES (:hid, '2023-01-01 00:00:00', 1.0, :name, :id, 'u1', 'Warned')"),
+                dict(hid=hid, name='history ' + history_id, id=history_id))
+        connection.execute(sa.text(
+            "INSERT INTO notification_table (id, user_id, message_id, sent, status, type) "
+            "VALUES (1, 'u1', '101', '2023-01-02 00:00:00', 'success', 'Warning')"))
+        connection.execute(sa.text(
+            "INSERT INTO history_notification_table (id, history_id, h_date, notification_id) "
+            "VALUES (1, 'h1', '2023-01-01 00:00:00', 1)"))
+
+
+def row_counts(engine):
+    with engine.connect() as connection:
+        return {table: connection.execute(sa.text(f"SELECT COUNT(*) FROM {table}")).scalar() for table in TABLES}
+
+
+def indexes(engine):
+    inspector = sa.inspect(engine)
+    return {table: {index['name']: bool(index['unique']) for index in inspector.get_indexes(table)}
+            for table in inspector.get_table_names()}
+
+
+def check(duplicates, workdir):
+    failures = []
+    db_path = os.path.join(workdir, 'duplicates.sqlite' if duplicates else 'unique.sqlite')
+    os.environ['HISTORY_MAILER_DB'] = db_path
+    alembic_config = Config(os.path.join(REPO, 'alembic.ini'))
+    alembic_config.set_main_option('script_location', os.path.join(REPO, 'alembic'))
+    engine = sa.create_engine('sqlite:///' + db_path)
+
+    command.upgrade(alembic_config, FIRST_REVISION)
+    populate(engine, duplicates)
+    counts = row_counts(engine)
+
+    command.upgrade(alembic_config, 'head')
+    found = indexes(engine)
+    for table, name in ID_INDEXES.items():
+        if name not in found[table]:
+            failures.append(f"upgrade did not create {name}")
+        elif found[table][name] == duplicates:
+            failures.append(f"{name} is {'unique' if found[table][name] else 'non-unique'}")
+    for table, names in LOOKUP_INDEXES.items():
+        failures.extend(f"upgrade did not create {name}" for name in names if name not in found[table])
+    for model_table in models.Base.metadata.sorted_tables:
+        for index in model_table.indexes:
+            if index.name not in found.get(model_table.name, {}):
+                failures.append(f"{index.name} from models.py is missing at head")
+    if row_counts(engine) != counts:
+        failures.append(f"upgrade changed the row counts from {counts} to {row_counts(engine)}")
+
+    command.downgrade(alembic_config, FIRST_REVISION)
+    found = indexes(engine)
+    for table, names in list(LOOKUP_INDEXES.items()) + [(table, [name]) for table, name in ID_INDEXES.items()]:
+        failures.extend(f"downgrade left {name}" for name in names if name in found[table])
+    if row_counts(engine) != counts:
+        failures.append(f"downgrade changed the row counts from {counts} to {row_counts(engine)}")
+    engine.dispose()
+    return failures
+
+
+def main():
+    workdir = tempfile.mkdtemp(prefix='history_mailer_migrations_')
+    failed = False
+    try:
+        for duplicates in [False, True]:
+            failures = check(duplicates, workdir)
+            label = 'with duplicate ids' if duplicates else 'with unique ids'
+            print(f"{label}: " + ('FAILED' if failures else 'ok'))
+            for failure in failures:
+                print("  " + failure)
+            failed = failed or bool(failures)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
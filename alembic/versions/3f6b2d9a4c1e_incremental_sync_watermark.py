@@ -0,0 +1,35 @@
+"""Incremental sync watermark
+
+Revision ID: 3f6b2d9a4c1e
+Revises: 1c2fa871bb2b
+Create Date: 2026-10-18 09:12:40.311842
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f6b2d9a4c1e'
+down_revision = '1c2fa871bb2b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('sync_table',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('server', sa.String(length=256), nullable=False),
+    sa.Column('scan_time', sa.DateTime(), nullable=False),
+    sa.Column('threshold', sa.DateTime(), nullable=False),
+    sa.Column('new_histories', sa.Integer(), nullable=False),
+    sa.Column('changed_histories', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.add_column('history_table', sa.Column('sync_id', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('history_table') as batch_op:
+        batch_op.drop_column('sync_id')
+    op.drop_table('sync_table')
@@ -0,0 +1,26 @@
+"""User details refresh time
+
+Revision ID: 5a1f8e3c9b07
+Revises: e2a9c4d7f316
+Create Date: 2026-10-18 13:41:09.274630
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a1f8e3c9b07'
+down_revision = 'e2a9c4d7f316'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # existing rows have no refresh time, so they are fetched again on their next run
+    op.add_column('user_table', sa.Column('refreshed', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('user_table') as batch_op:
+        batch_op.drop_column('refreshed')
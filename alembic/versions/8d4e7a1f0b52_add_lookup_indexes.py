@@ -0,0 +1,48 @@
+"""Add lookup indexes
+
+Revision ID: 8d4e7a1f0b52
+Revises: 3f6b2d9a4c1e
+Create Date: 2026-10-18 10:02:17.554106
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d4e7a1f0b52'
+down_revision = '3f6b2d9a4c1e'
+branch_labels = None
+depends_on = None
+
+
+def has_duplicates(table, column):
+    bind = op.get_bind()
+    query = sa.text(f"SELECT {column} FROM {table} GROUP BY {column} HAVING COUNT(*) > 1 LIMIT 1")
+    return bind.execute(query).first() is not None
+
+
+def create_id_index(table):
+    # Galaxy ids should be unique, but older databases may hold duplicate rows from concurrent runs
+    unique = not has_duplicates(table, 'id')
+    if not unique:
+        print(f"WARNING: {table} has duplicate ids; creating a non-unique index. Remove the duplicates and recreate ix_{table}_id as unique.")
+    op.create_index(f'ix_{table}_id', table, ['id'], unique=unique)
+
+
+def upgrade():
+    create_id_index('history_table')
+    create_id_index('user_table')
+    op.create_index('ix_history_table_sync_id', 'history_table', ['sync_id'], unique=False)
+    op.create_index('ix_history_notification_table_history_id_h_date', 'history_notification_table', ['history_id', 'h_date'], unique=False)
+    op.create_index('ix_history_notification_table_notification_id', 'history_notification_table', ['notification_id'], unique=False)
+    op.create_index('ix_notification_table_type', 'notification_table', ['type'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_notification_table_type', table_name='notification_table')
+    op.drop_index('ix_history_notification_table_notification_id', table_name='history_notification_table')
+    op.drop_index('ix_history_notification_table_history_id_h_date', table_name='history_notification_table')
+    op.drop_index('ix_history_table_sync_id', table_name='history_table')
+    op.drop_index('ix_user_table_id', table_name='user_table')
+    op.drop_index('ix_history_table_id', table_name='history_table')
@@ -0,0 +1,32 @@
+"""Keeplist member cache
+
+Revision ID: b7c3e5f9a2d8
+Revises: 8d4e7a1f0b52
+Create Date: 2026-10-18 10:48:03.920415
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7c3e5f9a2d8'
+down_revision = '8d4e7a1f0b52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('keeplist_table',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('server', sa.String(length=256), nullable=False),
+    sa.Column('user_id', sa.String(length=256), nullable=False),
+    sa.Column('fetched', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_keeplist_table_server', 'keeplist_table', ['server'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_keeplist_table_server', table_name='keeplist_table')
+    op.drop_table('keeplist_table')
@@ -0,0 +1,50 @@
+"""Run journal for resuming interrupted runs
+
+Revision ID: e2a9c4d7f316
+Revises: b7c3e5f9a2d8
+Create Date: 2026-10-18 13:02:41.518273
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2a9c4d7f316'
+down_revision = 'b7c3e5f9a2d8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('run_journal_table',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('server', sa.String(length=256), nullable=False),
+    sa.Column('do_delete', sa.Boolean(), nullable=False),
+    sa.Column('started', sa.DateTime(), nullable=False),
+    sa.Column('finished', sa.DateTime(), nullable=True),
+    sa.Column('status', sa.String(length=64), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_run_journal_table_server', 'run_journal_table', ['server'], unique=False)
+    op.create_table('run_journal_entry_table',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('run_id', sa.Integer(), nullable=False),
+    sa.Column('phase', sa.String(length=64), nullable=False),
+    sa.Column('position', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.String(length=256), nullable=False),
+    sa.Column('history_id', sa.String(length=256), nullable=False),
+    sa.Column('h_date', sa.DateTime(), nullable=False),
+    sa.Column('del_date', sa.DateTime(), nullable=True),
+    sa.Column('status', sa.String(length=64), nullable=True),
+    sa.ForeignKeyConstraint(['run_id'], ['run_journal_table.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_run_journal_entry_table_run_id_phase_user_id', 'run_journal_entry_table', ['run_id', 'phase', 'user_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_run_journal_entry_table_run_id_phase_user_id', table_name='run_journal_entry_table')
+    op.drop_table('run_journal_entry_table')
+    op.drop_index('ix_run_journal_table_server', table_name='run_journal_table')
+    op.drop_table('run_journal_table')
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of decoding history pages: JSON decoding plus update_time parsing.
+
+Compares the previous path (res.json() and dateutil for every timestamp) with history_mailer's decode path
+(loads_json and parse_history_page), and checks that both produce the same data.
+
+Example:
+  python benchmarks/decode_benchmark.py --histories 200000 --page-size 1000
+"""
+import argparse, json, os, sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_servers
+from run_benchmark import REPO, load_sample_config
+
+argparser = argparse.ArgumentParser(description='Benchmark decoding of Galaxy history pages')
+argparser.add_argument('--histories', type=int, default=100000, help="Number of histories to decode (default: 100000)")
+argparser.add_argument('--page-size', type=int, default=100, help="Histories per page (default: 100)")
+argparser.add_argument('--repeat', type=int, default=3, help="Runs of each path; the fastest is reported (default: 3)")
+
+
+def dateutil_path(pages):
+    from dateutil import parser
+    ret = []
+    for content in pages:
+        page = json.loads(content.decode('utf-8'))
+        for response in page:
+            response['update_time'] = parser.parse(response['update_time'])
+        ret.append(page)
+    return ret
+
+
+def fromisoformat_path(pages):
+    import history_mailer
+    return [history_mailer.parse_history_page(json.loads(content)) for content in pages]
+
+
+def decode_path(pages):
+    import history_mailer
+    return [history_mailer.parse_history_page(history_mailer.loads_json(content)) for content in pages]
+
+
+def as_dicts(pages):
+    # decoded pages hold HistoryRecords, which compare by their fields
+    return [[dict(history) for history in page] for page in pages]
+
+
+def best_time(func, pages, repeat):
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        result = func(pages)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main(args):
+    config = load_sample_config()
+    sys.path.insert(0, REPO)
+    import history_mailer
+
+    instance = fake_servers.Instance(histories=args.histories, users=max(1, args.histories // 20))
+    keys = config.GALAXY_DEFAULT_KEYS.split(',')
+    rows = [{key: h[key] for key in keys} for h in instance.histories]
+    pages = [json.dumps(rows[i:i + args.page_size]).encode() for i in range(0, len(rows), args.page_size)]
+    print(f"{args.histories} histories in {len(pages)} pages of {args.page_size}, "
+          f"{sum(len(page) for page in pages) / 1024.0 ** 2:.1f} MB of JSON")
+
+    paths = [('res.json() + dateutil (previous)', dateutil_path), ('json + fromisoformat', fromisoformat_path)]
+    if history_mailer.orjson is not None:
+        paths.append(('orjson + fromisoformat', decode_path))
+    else:
+        print("orjson is not installed; history_mailer decodes with the json module")
+
+    baseline = None
+    expected = None
+    for name, func in paths:
+        seconds, result = best_time(func, pages, args.repeat)
+        result = as_dicts(result)
+        if expected is None:
+            baseline, expected = seconds, result
+        same = result == expected
+        print(f"  {name:<34} {seconds:8.3f}s  {args.histories / seconds:12.0f} histories/s  "
+              f"{baseline / seconds:5.1f}x  {'same data' if same else 'DIFFERENT DATA'}")
+
+
+if __name__ == "__main__":
+    main(argparser.parse_args())
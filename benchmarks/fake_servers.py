@@ -0,0 +1,199 @@
+"""In-process stand-ins for the Galaxy and Postal APIs used by history_mailer.py.
+
+Serves the endpoints the mailer calls, under one base URL:
+  GET    /api/histories                 q/qv filters (purged, published, deleted, update_time-le/-ge), keys, limit, offset
+  GET    /api/histories/<id>            deleted/purged status
+  DELETE /api/histories/<id>?purge=     marks the history deleted (and purged)
+  GET    /api/users/<id>
+  GET    /api/groups/ and /api/groups/<id>/users
+  POST   /postal/send/message
+"""
+import json, random, threading
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from time import sleep
+from urllib.parse import urlparse, parse_qs
+
+KEEPLIST_GROUP = "History Retention Keeplist"
+
+
+class Instance:
+    """A synthetic Galaxy instance.
+
+    Users are drawn for each history with weight 1/rank**skew, so a skew of 0 spreads histories evenly and larger
+    values concentrate them on a few heavy users. update_time is spread uniformly over the last max_age_days.
+    """
+
+    def __init__(self, histories=10000, users=1000, skew=1.0, max_age_days=450, keeplist_fraction=0.05,
+                 null_user_fraction=0.01, latency=0.0, seed=1):
+        rnd = random.Random(seed)
+        now = datetime.now()
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.sent = 0
+
+        self.user_ids = ['%016x' % (0x10000000 + i) for i in range(users)]
+        self.users = {}
+        for i, uid in enumerate(self.user_ids):
+            self.users[uid] = {
+                'id': uid, 'username': 'user%d' % i, 'email': 'user%d@example.org' % i,
+                'nice_total_disk_usage': '1.0 GB', 'total_disk_usage': 1073741824.0, 'quota_percent': 10.0,
+                'quota': '10 GB', 'is_admin': False, 'purged': False, 'deleted': False,
+                'preferences': {}, 'tags_used': [],
+            }
+
+        weights = [1.0 / (rank + 1) ** skew for rank in range(users)]
+        owners = rnd.choices(self.user_ids, weights=weights, k=histories)
+        self.histories = []
+        self.by_id = {}
+        for i in range(histories):
+            update_time = now - timedelta(seconds=rnd.randint(0, max_age_days * 86400))
+            history = {
+                'id': '%016x' % (0x20000000 + i), 'name': 'History %d' % i,
+                'user_id': None if rnd.random() < null_user_fraction else owners[i],
+                'update_time': update_time.isoformat(), 'size': float(rnd.randint(0, 10 * 1024 ** 3)),
+                'deleted': False, 'purged': False, 'published': False,
+            }
+            self.histories.append(history)
+            self.by_id[history['id']] = history
+
+        keeplisted = rnd.sample(self.user_ids, int(users * keeplist_fraction))
+        self.groups = [{'id': 'group%d' % i, 'name': 'Group %d' % i} for i in range(4)]
+        self.groups.append({'id': 'keeplist', 'name': KEEPLIST_GROUP})
+        self.group_users = {group['id']: [{'id': uid} for uid in self.user_ids[i::7]] for i, group in enumerate(self.groups)}
+        self.group_users['keeplist'] = [{'id': uid} for uid in keeplisted]
+        self._queries = {}
+
+    def count(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    def query(self, filters):
+        # Histories matching a tuple of (q, qv) filters, ordered like Galaxy by update_time descending.
+        # Results are cached per filter set since every page of a scan repeats the same filters.
+        with self.lock:
+            rows = self._queries.get(filters)
+            if rows is not None:
+                return rows
+            names = [q for q, qv in filters]
+            rows = self.histories if 'deleted' in names else [h for h in self.histories if not h['deleted']]
+            for q, qv in filters:
+                if q in ('purged', 'published', 'deleted'):
+                    rows = [h for h in rows if str(h[q]) == qv]
+                elif q == 'update_time-le':
+                    rows = [h for h in rows if h['update_time'] <= qv]
+                elif q == 'update_time-ge':
+                    rows = [h for h in rows if h['update_time'] >= qv]
+            rows = sorted(rows, key=lambda h: h['update_time'], reverse=True)
+            self._queries[filters] = rows
+            return rows
+
+    def delete(self, history_id, purge):
+        with self.lock:
+            history = self.by_id.get(history_id)
+            if history is None:
+                return None
+            history['deleted'] = True
+            history['purged'] = history['purged'] or purge
+            history['update_time'] = datetime.now().isoformat()
+            self._queries.clear()
+            return history
+
+    def send(self):
+        with self.lock:
+            self.sent += 1
+            return self.sent
+
+
+def make_handler(instance):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # headers and body go out in separate writes; without this keep-alive replies stall on delayed ACKs
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def reply(self, data, status=200):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def route(self):
+            if instance.latency:
+                sleep(instance.latency)
+            url = urlparse(self.path)
+            return url, parse_qs(url.query, keep_blank_values=True), [part for part in url.path.split('/') if part]
+
+        def do_GET(self):
+            url, query, parts = self.route()
+            if parts[:2] == ['api', 'histories'] and len(parts) == 2:
+                instance.count('histories')
+                rows = instance.query(tuple(zip(query.get('q', []), query.get('qv', []))))
+                offset = int(query.get('offset', ['0'])[0])
+                limit = int(query.get('limit', ['100'])[0])
+                keys = query.get('keys', ['id'])[0].split(',')
+                return self.reply([{key: h[key] for key in keys} for h in rows[offset:offset + limit]])
+            if parts[:2] == ['api', 'histories']:
+                instance.count('history')
+                history = instance.by_id.get(parts[2])
+                return self.reply(history) if history else self.reply({'err_msg': 'not found'}, 404)
+            if parts[:2] == ['api', 'users']:
+                instance.count('users')
+                user = instance.users.get(parts[2])
+                return self.reply(user) if user else self.reply({'err_msg': 'not found'}, 404)
+            if parts[:2] == ['api', 'groups']:
+                instance.count('groups')
+                if len(parts) == 2:
+                    return self.reply(instance.groups)
+                return self.reply(instance.group_users.get(parts[2], []))
+            self.reply({'err_msg': 'not found'}, 404)
+
+        def do_DELETE(self):
+            url, query, parts = self.route()
+            instance.count('delete')
+            history = instance.delete(parts[2], query.get('purge', ['False'])[0] == 'True')
+            return self.reply(history) if history else self.reply({'err_msg': 'not found'}, 404)
+
+        def do_POST(self):
+            url, query, parts = self.route()
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            instance.count('send')
+            self.reply({'status': 'success', 'data': {'message_id': instance.send()}})
+
+    return Handler
+
+
+def start(instance, host='127.0.0.1', port=0):
+    """Serve instance on a background thread. Returns the server; its base URL is base_url(server)."""
+    server = ThreadingHTTPServer((host, port), make_handler(instance))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def base_url(server):
+    host, port = server.server_address[:2]
+    return f'http://{host}:{port}/'
+
+
+def serve_forever(conn, **kwargs):
+    """Build an Instance and serve it; used as a separate process so the mailer's RSS is measured on its own.
+
+    Sends the base URL down conn, then answers 'calls' with the per-endpoint request counts until 'stop'.
+    """
+    instance = Instance(**kwargs)
+    server = start(instance)
+    conn.send(base_url(server))
+    while True:
+        command = conn.recv()
+        if command == 'calls':
+            with instance.lock:
+                conn.send(dict(instance.calls))
+        elif command == 'stop':
+            server.shutdown()
+            return
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""End-to-end benchmark of history_mailer.main() against fake Galaxy and Postal servers.
+
+A synthetic instance is served from a separate process, and each selected mode runs main() in a freshly spawned
+process, so the reported peak RSS is that mode's own. Per stage, the peak is the one reached while the stage ran (see
+metrics.py). The modes run in turn against one temporary SQLite database, so warn leaves the notifications that delete
+acts on and delete leaves the deletions that purge acts on. Warning and purge thresholds are set to -1 days for this.
+
+Examples:
+  python benchmarks/run_benchmark.py --histories 100000 --users 5000 --skew 1.2 --latency 0.005
+  python benchmarks/run_benchmark.py --histories 1000000 --modes dryrun --set GALAXY_HISTORIES_SCAN_WORKERS=8
+"""
+import argparse, ast, importlib.machinery, importlib.util, json, multiprocessing, os, shutil, sys, tempfile
+from contextlib import redirect_stdout
+from time import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_servers
+
+MODES = {
+    'dryrun': dict(dryrun=True),
+    'warn': dict(dryrun=False),
+    'delete': dict(dryrun=False, do_delete=True),
+    'purge': dict(dryrun=False, purge=True),
+}
+
+argparser = argparse.ArgumentParser(description='Benchmark history_mailer.py against local fake Galaxy and Postal servers')
+argparser.add_argument('--histories', type=int, default=10000, help="Number of histories in the synthetic instance (default: 10000)")
+argparser.add_argument('--users', type=int, default=1000, help="Number of users in the synthetic instance (default: 1000)")
+argparser.add_argument('--skew', type=float, default=1.0, help="Zipf exponent for history ownership; 0 spreads histories evenly (default: 1.0)")
+argparser.add_argument('--latency', type=float, default=0.0, help="Seconds added to every fake API response (default: 0)")
+argparser.add_argument('--seed', type=int, default=1, help="Random seed for the synthetic instance")
+argparser.add_argument('--modes', default='dryrun,warn,delete,purge', help="Comma separated modes to run in order (default: dryrun,warn,delete,purge)")
+argparser.add_argument('--stream', action='store_const', const=True, default=False, help="Pass --stream to the history scan")
+argparser.add_argument('--incremental', action='store_const', const=True, default=False, help="Pass --incremental to the history scan")
+argparser.add_argument('--pipeline', action='store_const', const=True, default=False, help="Pass --pipeline to warn and delete runs")
+argparser.add_argument('--shards', type=int, default=1, help="Pass --shards to warn and delete runs (default: 1)")
+argparser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE', help="Override a config value, e.g. --set MAIL_SEND_WORKERS=8")
+argparser.add_argument('--output', help="Also write the results as JSON to this file")
+argparser.add_argument('--verbose', action='store_const', const=True, default=False, help="Show the mailer's own output")
+
+
+def load_sample_config():
+    """Install config.py.sample as the config module, so a local config.py can never point a benchmark at a real server."""
+    loader = importlib.machinery.SourceFileLoader('config', os.path.join(REPO, 'config.py.sample'))
+    spec = importlib.util.spec_from_loader('config', loader)
+    config = importlib.util.module_from_spec(spec)
+    loader.exec_module(config)
+    sys.modules['config'] = config
+    return config
+
+
+def load_config(base_url, db_path, overrides):
+    config = load_sample_config()
+    config.STAGING_GALAXY_BASEURL = base_url + 'api/'
+    config.STAGING_GALAXY_API_KEY = 'benchmark'
+    config.STAGING_HIST_VIEW_BASE = base_url + 'histories/view?id='
+    config.STAGING_LOCAL_DB = 'sqlite:///' + db_path
+    config.MAIL_BASEURL = base_url + 'postal/'
+    config.MAIL_TEMPLATE_WARNING = os.path.join(REPO, config.MAIL_TEMPLATE_WARNING)
+    config.MAIL_TEMPLATE_DELETION = os.path.join(REPO, config.MAIL_TEMPLATE_DELETION)
+    config.EMAIL_DAYS_THRESHOLD = -1
+    config.PURGE_DAYS_THRESHOLD = -1
+    for override in overrides:
+        name, value = override.split('=', 1)
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+        setattr(config, name, value)
+    return config
+
+
+def run_main(conn, base_url, db_path, overrides, kwargs, verbose):
+    """Run history_mailer.main() in this (fresh) process and send back its wall time and metrics summary."""
+    load_config(base_url, db_path, overrides)
+    sys.path.insert(0, REPO)
+    import history_mailer, metrics
+    start = time()
+    if verbose:
+        history_mailer.main(**kwargs)
+    else:
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            history_mailer.main(**kwargs)
+    conn.send((time() - start, metrics.summary()))
+
+
+def run_mode(server, base_url, db_path, mode, args):
+    kwargs = dict(MODES[mode], stream=args.stream, incremental=args.incremental)
+    if mode != 'purge':
+        kwargs['pipeline'] = args.pipeline
+        kwargs['shards'] = args.shards
+    server.send('calls')
+    calls_before = server.recv()
+    context = multiprocessing.get_context('spawn')
+    parent, child = context.Pipe()
+    process = context.Process(target=run_main, args=(child, base_url, db_path, args.set, kwargs, args.verbose))
+    process.start()
+    child.close()
+    try:
+        wall, summary = parent.recv()
+    except EOFError:
+        process.join()
+        raise SystemExit(f"{mode} run failed (exit code {process.exitcode})")
+    process.join()
+    server.send('calls')
+    calls = {endpoint: count - calls_before.get(endpoint, 0) for endpoint, count in server.recv().items()}
+    return {
+        'mode': mode,
+        'seconds': wall,
+        'histories_per_second': args.histories / wall if wall > 0 else None,
+        'peak_rss_mb': summary['max_rss_bytes'] / 1024.0 ** 2,
+        'calls': {endpoint: count for endpoint, count in calls.items() if count},
+        'db_commits': summary['counters'].get('db_commits', 0),
+        'db_commits_per_email': summary['counters'].get('db_commits', 0) / calls['send'] if calls.get('send') else None,
+        'stages': {name: {'seconds': stage['seconds'], 'peak_rss_mb': stage['max_rss_bytes'] / 1024.0 ** 2}
+                   for name, stage in summary['stages'].items()},
+        'messages': summary['info'].get('messages', []),
+    }
+
+
+def report(result):
+    print(f"{result['mode']}: {result['seconds']:.2f}s, {result['histories_per_second']:.0f} histories/s, "
+          f"peak RSS {result['peak_rss_mb']:.1f} MB, {result['db_commits']} DB commits")
+    if result['db_commits_per_email'] is not None:
+        print(f"  {result['db_commits_per_email']:.1f} DB commits per email sent")
+    print("  requests: " + ', '.join(f"{endpoint}={count}" for endpoint, count in sorted(result['calls'].items())))
+    for name, stage in result['stages'].items():
+        print(f"  {name:<20} {stage['seconds']:9.3f}s  peak RSS {stage['peak_rss_mb']:8.1f} MB")
+    for msg in result['messages']:
+        print("  | " + msg)
+
+
+def main(args):
+    modes = [mode.strip() for mode in args.modes.split(',') if mode.strip()]
+    for mode in modes:
+        if mode not in MODES:
+            argparser.error(f"unknown mode {mode}; choose from {', '.join(MODES)}")
+
+    workdir = tempfile.mkdtemp(prefix='history_mailer_bench_')
+    parent, child = multiprocessing.Pipe()
+    server_process = multiprocessing.Process(target=fake_servers.serve_forever, args=(child,), kwargs=dict(
+        histories=args.histories, users=args.users, skew=args.skew, latency=args.latency, seed=args.seed), daemon=True)
+    start = time()
+    server_process.start()
+    base_url = parent.recv()
+    print(f"Synthetic instance: {args.histories} histories, {args.users} users, skew {args.skew}, "
+          f"latency {args.latency}s (built in {time() - start:.1f}s)")
+
+    try:
+        db_path = os.path.join(workdir, 'benchmark.sqlite')
+        load_config(base_url, db_path, args.set)
+        sys.path.insert(0, REPO)
+        import models
+        from sqlalchemy import create_engine
+        models.Base.metadata.create_all(create_engine(sys.modules['config'].STAGING_LOCAL_DB))
+
+        results = []
+        for mode in modes:
+            result = run_mode(parent, base_url, db_path, mode, args)
+            report(result)
+            results.append(result)
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump({'parameters': vars(args), 'results': results}, f, indent=2)
+    finally:
+        parent.send('stop')
+        server_process.join(5)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(argparser.parse_args())
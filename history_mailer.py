@@ -1,14 +1,25 @@
 #!/usr/bin/env python3
-import json, requests, argparse, sys, slack
-from collections import namedtuple
+import json, requests, argparse, sys, os, threading, asyncio, multiprocessing, zlib, slack
+from array import array
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
 import config
 from time import time, sleep
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from dateutil import parser
-from jinja2 import Template
-from models import Base, History, User, Notification, Message, HistoryNotification
-from sqlalchemy import create_engine
+from jinja2 import Environment, FunctionLoader, FileSystemBytecodeCache
+from models import Base, History, User, Notification, Message, HistoryNotification, Sync, KeeplistMember, RunJournal, RunJournalEntry, bulk_upsert
+from sqlalchemy import create_engine, event, select, func, exists, and_, or_
 from sqlalchemy.orm import sessionmaker
+import metrics
+try:
+  import orjson
+except ImportError:
+  orjson = None
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 Session = None
 session = requests.Session()
@@ -17,6 +28,19 @@ GALAXY_API_KEY: str
 GALAXY_HIST_VIEW_BASE: str
 NULL_USER_DETAILS = {"Status":"Not Available"}
 SLACK_CLIENT = slack.WebClient(token=config.SLACK_TOKEN)
+HTTP_POOL_SIZE = requests.adapters.DEFAULT_POOLSIZE
+KEEPLIST_MEMBERS = None
+TEMPLATE_ENV = None
+RENDER_CONTEXT = None
+SCAN_MSGS = []
+SCAN_EXECUTORS = []
+MAIL_RATE_LOCK = threading.Lock()
+MAIL_NEXT_SEND = 0.0
+EPOCH = datetime(1970, 1, 1)
+ONE_MICROSECOND = timedelta(microseconds=1)
+HISTORY_PAGE_RETRIES = 3
+PIPELINE_END = object()
+SHARD_WORK = None
 
 argparser = argparse.ArgumentParser(description='Manage user histories in Galaxy')
 argparser.add_argument('-d', '--dryrun', action='store_const',const=True, default=False, help="Do a dry run. List affected users, but do not send emails or delete histories")
@@ -27,6 +51,12 @@ argparser.add_argument('--production', action='store_const',const=True, default=
 argparser.add_argument('--notify', action='store_const',const=True, default=False, help="Post results to Slack")
 argparser.add_argument('--drop_db', action='store_const',const=True, default=False, help="Drop associated database. Does not do processing.")
 argparser.add_argument('--purge', action='store_const',const=True, default=False, help="Purges previously deleted histories.")
+argparser.add_argument('--compact', action='store_const',const=True, default=False, help="Move resolved notifications and histories to the archive database, then vacuum the local database. Does not do processing.")
+argparser.add_argument('--stream', action='store_const',const=True, default=False, help="Classify and group histories page by page as they are received instead of collecting the full scan first.")
+argparser.add_argument('--incremental', action='store_const',const=True, default=False, help="Only query histories that changed or crossed the warning threshold since the last incremental run, reusing the local history mirror.")
+argparser.add_argument('--pipeline', action='store_const',const=True, default=False, help="Overlap the history scan, user lookups, emails and deletions in one pipeline instead of running them one after another.")
+argparser.add_argument('--shards', type=int, default=1, help="Split the users of a warn or delete run between this many worker processes.")
+argparser.add_argument('--resume', action='store_const',const=True, default=False, help="Continue the last interrupted warn or delete run from its journal, without scanning histories again.")
 
 
 def notify_slack(title, msg, colour):
@@ -43,53 +73,474 @@ def notify_slack(title, msg, colour):
   )
   return
 
-def get_all_histories(warn_days, published="False",limit=100,keys=config.GALAXY_DEFAULT_KEYS):
+def endpoint_name(request):
+  # Label for a request in the run metrics: the Postal send endpoint or the Galaxy API it queried
+  url = request.url.split('?')[0]
+  if config.MAIL_BASEURL and url.startswith(config.MAIL_BASEURL):
+    return 'postal_send'
+  if GALAXY_BASEURL and url.startswith(GALAXY_BASEURL):
+    parts = [part for part in url[len(GALAXY_BASEURL):].split('/') if part]
+    if parts and parts[0] == config.GALAXY_HISTORIES_EP:
+      if len(parts) == 1:
+        return 'galaxy_histories'
+      return 'galaxy_history_delete' if request.method == 'DELETE' else 'galaxy_history'
+    if parts and parts[0] == config.GALAXY_USER_EP:
+      return 'galaxy_users'
+    if parts and parts[0] + '/' == config.GALAXY_GROUP_EP:
+      return 'galaxy_groups'
+  return 'other'
+
+def record_response(res, *args, **kwargs):
+  metrics.observe_request(endpoint_name(res.request), res.elapsed.total_seconds(), res.status_code)
+
+session.hooks['response'].append(record_response)
+
+def write_metrics(msgs=[]):
+  metrics.set_info('messages', msgs)
+  data = metrics.write(getattr(config, 'METRICS_JSON_FILE', ''), getattr(config, 'METRICS_PROM_FILE', ''))
+  for name, stage in data['stages'].items():
+    print(f"Stage {name}: {timedelta(seconds=stage['seconds'])}")
+
+def set_http_pool_size(size):
+  # requests keeps DEFAULT_POOLSIZE connections per host; grow it so concurrent workers don't discard connections
+  global HTTP_POOL_SIZE
+  if size <= HTTP_POOL_SIZE:
+    return
+  HTTP_POOL_SIZE = size
+  adapter = requests.adapters.HTTPAdapter(pool_maxsize=size)
+  session.mount('http://', adapter)
+  session.mount('https://', adapter)
+
+def iter_ordered(func, items, workers=1):
+  # Yields func(item) for each item in order, keeping up to `workers` calls running on a thread pool and a
+  # bounded number of finished results waiting to be consumed.
+  if workers <= 1:
+    for item in items:
+      yield func(item)
+    return
+
+  set_http_pool_size(workers)
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    pending = deque()
+    for item in items:
+      pending.append(executor.submit(func, item))
+      if len(pending) >= workers * 2:
+        yield pending.popleft().result()
+    while pending:
+      yield pending.popleft().result()
+
+def history_fields(keys):
+  # The fields a HistoryRecord holds: those the mailer reads, then any other keys requested in GALAXY_DEFAULT_KEYS
+  fields = tuple(dict.fromkeys(['id', 'name', 'user_id', 'update_time', 'size'] + [key.strip() for key in keys.split(',') if key.strip()]))
+  reserved = ('del_date', 'keys', 'h_update_time', 'h_size', 'h_del_time')
+  unsupported = [key for key in fields if not key.isidentifier() or key.startswith('_') or key in reserved]
+  if unsupported:
+    raise ValueError("GALAXY_DEFAULT_KEYS holds keys that can't be kept on a history: " + ', '.join(unsupported))
+  return fields
+
+class HistoryRecord:
+  # A history from the Galaxy API, held in slots instead of its JSON dict. Fields are read by key, as the dicts were,
+  # or as attributes; fields Galaxy didn't return are missing as they would be from the dict. The display fields of
+  # the mail templates (h_update_time, h_size and h_del_time) are formatted only when a template reads them.
+  FIELDS = history_fields(config.GALAXY_DEFAULT_KEYS)
+  __slots__ = FIELDS + ('del_date',)
+
+  def __init__(self, dictionary):
+    for key in self.FIELDS:
+      if key in dictionary:
+        setattr(self, key, dictionary[key])
+    self.del_date = None  # deletion date given in a warning
+
+  def __getitem__(self, key):
+    try:
+      return getattr(self, key)
+    except AttributeError:
+      raise KeyError(key)
+
+  def __contains__(self, key):
+    return key in self.FIELDS and hasattr(self, key)
+
+  def keys(self):
+    return [key for key in self.FIELDS if hasattr(self, key)]
+
+  @property
+  def h_update_time(self):
+    return str(self.update_time.strftime('%Y-%m-%d'))
+
+  @property
+  def h_size(self):
+    return sizeof_fmt(self.size)
+
+  @property
+  def h_del_time(self):
+    return str(self.del_date.strftime('%Y-%m-%d'))
+
+  def __repr__(self):
+    return '<History Record {}>'.format(getattr(self, 'id', None))
+
+def loads_json(content):
+  # orjson decodes large history pages several times faster than the json module, so it is used when installed
+  if orjson is not None:
+    return orjson.loads(content)
+  return json.loads(content)
+
+def galaxy_now():
+  # The current time as Galaxy records update_time: naive, in UTC
+  return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def parse_update_time(value):
+  # Galaxy returns fixed ISO-8601 timestamps, which fromisoformat reads far faster than dateutil.
+  # Anything fromisoformat doesn't accept still goes through dateutil.
+  try:
+    return datetime.fromisoformat(value)
+  except ValueError:
+    return parser.parse(value)
+
+def parse_history_page(page):
+  # Replace each history's dict with a HistoryRecord, parsing update_time
+  for i, response in enumerate(page):
+    history = HistoryRecord(response)
+    history.update_time = parse_update_time(history.update_time)
+    page[i] = history
+  return page
+
+class PageSizer:
+  # Page size of the histories query. With a target latency, the size doubles while pages come back in under half the
+  # target and halves after a slower page or a 5xx response, staying within min_size and max_size. Without a target
+  # the size stays fixed. Shared by all scan workers.
+  def __init__(self, size, target=0, min_size=10, max_size=5000):
+    self.initial = size
+    self.size = size
+    self.target = target
+    self.min_size = min(min_size, size)
+    self.max_size = max(max_size, size)
+    self.smallest = size
+    self.largest = size
+    self.lock = threading.Lock()
+
+  def adaptive(self):
+    return self.target > 0
+
+  def observe(self, seconds, ok=True):
+    if not self.adaptive():
+      return
+    with self.lock:
+      if not ok or seconds > self.target:
+        self.size = max(self.min_size, self.size // 2)
+      elif seconds < self.target / 2:
+        self.size = min(self.max_size, self.size * 2)
+      self.smallest = min(self.smallest, self.size)
+      self.largest = max(self.largest, self.size)
+
+  def summary(self):
+    return dict(initial=self.initial, final=self.size, smallest=self.smallest, largest=self.largest, target_seconds=self.target)
+
+def get_history_page(queryURL, offset, limit, sizer=None):
+  # Returns histories offset to offset+limit. An adaptive sizer that has since shrunk splits the range into smaller
+  # requests, and a 5xx response is retried at the smaller size. A short response, from the end of the histories or a
+  # server side cap on the page size, is followed from where it stopped, so no histories are skipped.
+  page = []
+  end = offset + limit
+  retries = 0
+  while offset < end:
+    size = end - offset
+    if sizer is not None:
+      size = min(sizer.size, size)
+    start = time()
+    res=session.get(queryURL + '&limit=' + str(size) + '&offset=' + str(offset))
+    if sizer is not None:
+      sizer.observe(time() - start, res.status_code < 500)
+
+    if res.status_code != 200:
+      if res.status_code >= 500 and sizer is not None and sizer.adaptive() and retries < HISTORY_PAGE_RETRIES:
+        retries += 1
+        continue
+      print("ERROR: Request did not return ok: " + res.reason + ': ' + res.text)
+      return None
+
+    rows = loads_json(res.content)
+    if len(rows) == 0:
+      break
+    page.extend(rows)
+    offset += len(rows)
+
+  return page
+
+def iter_history_pages(queryURL, limit, workers=1, sizer=None):
+  # Yields pages of histories in offset order until the first empty page. A page of None signals a failed request.
+  # Each page is requested at the sizer's current size, or at limit without a sizer.
+  if sizer is None:
+    sizer = PageSizer(limit)
+  if workers <= 1:
+    offset = 0
+    while True:
+      limit = sizer.size
+      page = get_history_page(queryURL, offset, limit, sizer)
+      if not page:
+        if page is None:
+          yield None
+        return
+      yield page
+      offset += limit
+
+  set_http_pool_size(workers)
+  executor = ThreadPoolExecutor(max_workers=workers)
+  pending = deque()
+  next_offset = 0
+
+  def submit():
+    nonlocal next_offset
+    limit = sizer.size
+    pending.append(executor.submit(get_history_page, queryURL, next_offset, limit, sizer))
+    next_offset += limit
+
+  try:
+    for _ in range(workers):
+      submit()
+
+    while pending:
+      page = pending.popleft().result()
+      if not page:
+        if page is None:
+          yield None
+        return
+      yield page
+      submit()
+  finally:
+    # pages past the end are empty; drop anything still queued and let in-flight requests finish in the background,
+    # until wait_for_scans
+    executor.shutdown(wait=False, cancel_futures=True)
+    SCAN_EXECUTORS.append(executor)
+
+def wait_for_scans():
+  # Waits for the history requests left in flight by finished scans. A process must not fork while their threads
+  # may hold a lock, such as the metrics lock taken by record_response, which the child would then wait on forever.
+  while SCAN_EXECUTORS:
+    SCAN_EXECUTORS.pop().shutdown(wait=True)
+
+def iter_history_batches(warn_days, published="False", limit=None, keys=None, workers=None, filters=None, scan='candidates'):
+  # Yields each page of histories as it arrives with update_time parsed. A batch of None signals a failed request.
+  # filters is a list of (q, qv) pairs; by default non-purged histories not updated within warn_days are selected.
+  # With GALAXY_HISTORIES_PAGE_TARGET_SECONDS set, the page size starts at limit and adapts to the response times, and
+  # the sizes chosen are reported under the scan's name, in the metrics and in the run's messages. limit, keys and
+  # workers default to GALAXY_HISTORIES_PAGE_SIZE, GALAXY_DEFAULT_KEYS and GALAXY_HISTORIES_SCAN_WORKERS.
   global GALAXY_BASEURL
   global GALAXY_API_KEY
+  if limit is None:
+    limit = getattr(config, 'GALAXY_HISTORIES_PAGE_SIZE', 100)
+  if keys is None:
+    keys = config.GALAXY_DEFAULT_KEYS
+  if workers is None:
+    workers = getattr(config, 'GALAXY_HISTORIES_SCAN_WORKERS', 1)
   print("Querying histories...")
   start=time()
-  wt = datetime.now() - timedelta(days=warn_days)
+  if filters is None:
+    wt = galaxy_now() - timedelta(days=warn_days)
+    filters = [('purged', 'False'), ('published', published), ('update_time-le', str(wt.isoformat()))]
   apiURL = GALAXY_BASEURL + config.GALAXY_HISTORIES_EP
-  queryURL = apiURL+'?all=true&key='+ GALAXY_API_KEY + '&q=purged&qv=False&q=published&qv=' + published + \
-    '&q=update_time-le&qv=' + str(wt.isoformat()) + '&keys=' + keys + '&limit=' + str(limit)
-  ret = []
-  queries_left=True
-  offset=0
+  queryURL = apiURL+'?all=true&key='+ GALAXY_API_KEY + ''.join('&q=' + q + '&qv=' + qv for q, qv in filters) + \
+    '&keys=' + keys
+  sizer = PageSizer(limit, getattr(config, 'GALAXY_HISTORIES_PAGE_TARGET_SECONDS', 0), \
+    getattr(config, 'GALAXY_HISTORIES_PAGE_SIZE_MIN', 10), getattr(config, 'GALAXY_HISTORIES_PAGE_SIZE_MAX', 5000))
+  received = 0
+
+  for page in iter_history_pages(queryURL, limit, workers, sizer):
+    if page is None:
+      yield None
+      return
+
+    parse_history_page(page)
+    received += len(page)
+    sys.stdout.write("Received histories: " + str(received) + "   \r")
+    sys.stdout.flush()
+    yield page
 
-  while queries_left:
-    res=session.get(queryURL+ '&offset=' + str(offset))
+  print(str(received) + " histories returned. Query took: " + str(timedelta(seconds=time()-start)))
+  metrics.set_info('history_page_size_' + scan, sizer.summary())
+  if sizer.adaptive():
+    msg = f"Page size of the {scan} scan: started at {sizer.initial}, finished at {sizer.size} (between {sizer.smallest} and {sizer.largest})."
+    print(msg)
+    SCAN_MSGS.append(msg)
 
-    if res.status_code != 200:
-      print("ERROR: Request did not return ok: " + res.reason + ': ' + res.text)
+def get_all_histories(warn_days, published="False", limit=None, keys=None, workers=None, filters=None, scan='candidates'):
+  ret = []
+  for page in iter_history_batches(warn_days, published, limit, keys, workers, filters, scan):
+    if page is None:
       return False
+    ret.extend(page)
+  return ret
 
-    for response in res.json():
-      response['update_time'] = parser.parse(response['update_time'])
-      ret.append(response)
-
-    offset += limit
-    queries_left = len(res.json()) > 0
-    sys.stdout.write("Received histories: " + str(len(ret)) + "   \r")
-    sys.stdout.flush()
+def get_incremental_histories(warn_days, published="False"):
+  # Rebuild the candidate set from the local history mirror plus what changed in Galaxy since the last sync.
+  # Histories confirmed as candidates by the last sync carry its sync_id. Anything Galaxy reports as updated since
+  # that sync (deleted or not) is dropped from the mirror set, and histories whose update_time crossed the threshold
+  # since then are fetched, so API calls scale with the changes rather than the instance size.
+  global GALAXY_BASEURL
+  global Session
+  db_session = Session()
+  # The watermarks are in galaxy_now() time, as update_time is. Each sync also reaches back
+  # INCREMENTAL_SYNC_OVERLAP_HOURS before the previous one, so neither a history updated while that scan ran nor a
+  # watermark stored in local time by an earlier version on a host ahead of UTC can cause a change to be missed.
+  scan_time = galaxy_now()
+  wt = scan_time - timedelta(days=warn_days)
+  overlap = timedelta(hours=getattr(config, 'INCREMENTAL_SYNC_OVERLAP_HOURS', 24))
+  last_sync = db_session.query(Sync).filter_by(server=GALAXY_BASEURL).order_by(Sync.id.desc()).first()
+  changed_ids = set()
+  mirrored = []
+
+  if last_sync is None:
+    print("No previous sync recorded for this server. Running a full history scan.")
+    new_histories = get_all_histories(warn_days, published)
+    if new_histories is False:
+      db_session.close()
+      return False
+  else:
+    print("Syncing histories changed since " + str(last_sync.scan_time))
+    since = str((last_sync.scan_time - overlap).isoformat())
+    for deleted in ['True', 'False']:
+      changed = get_all_histories(warn_days, keys='id,update_time', filters=[('deleted', deleted), ('update_time-ge', since)], \
+        scan='changed_deleted' if deleted == 'True' else 'changed_undeleted')
+      if changed is False:
+        db_session.close()
+        return False
+      changed_ids.update(h['id'] for h in changed)
 
-  print(str(len(ret)) + " histories returned. Query took: " + str(timedelta(seconds=time()-start)))
-  return ret
+    new_histories = get_all_histories(warn_days, published, filters=[('purged', 'False'), ('published', published), \
+      ('update_time-ge', str((last_sync.threshold - overlap).isoformat())), ('update_time-le', str(wt.isoformat()))], scan='new_candidates')
+    if new_histories is False:
+      db_session.close()
+      return False
+    mirrored = db_session.query(History).filter(History.sync_id == last_sync.id, History.update_time <= wt).all()
+
+  sync = Sync()
+  sync.server = GALAXY_BASEURL
+  sync.scan_time = scan_time
+  sync.threshold = wt
+  sync.new_histories = len(new_histories)
+  sync.changed_histories = len(changed_ids)
+  db_session.add(sync)
+  db_session.flush()
+
+  # keys the local mirror has no column for are missing from carried histories, as if Galaxy hadn't returned them
+  keys = [key for key in HistoryRecord.FIELDS if hasattr(History, key)]
+  new_ids = set(h['id'] for h in new_histories)
+  histories = list(new_histories)
+  for h_model in mirrored:
+    if h_model.id in changed_ids or h_model.id in new_ids:
+      continue
+    h_model.sync_id = sync.id
+    histories.append(HistoryRecord({key: getattr(h_model, key) for key in keys}))
 
-def filter_histories_update_time(histories, warn_days, delete_days):
-  wt = datetime.now() - timedelta(days=warn_days)
-  dt = datetime.now() - timedelta(days=delete_days)
+  bulk_upsert(db_session, History, new_histories, values={'sync_id': sync.id})
+  db_session.commit()
+  db_session.close()
+  print(f"Incremental sync: {len(new_ids)} histories crossed the threshold, {len(changed_ids)} changed, {len(histories) - len(new_ids)} carried from the local mirror.")
+  return histories
+
+def to_microseconds(time):
+  return (time - EPOCH) // ONE_MICROSECOND
+
+def history_columns(histories):
+  # update_time (as microseconds since EPOCH) and size of each history as NumPy arrays, or array.array without NumPy
+  times = array('q', [(history['update_time'] - EPOCH) // ONE_MICROSECOND for history in histories])
+  sizes = array('d', [history['size'] for history in histories])
+  if numpy is not None:
+    return numpy.frombuffer(times, dtype=numpy.int64), numpy.frombuffer(sizes, dtype=numpy.float64)
+  return times, sizes
+
+def split_by_age(times, warn_before, delete_before):
+  # Indices of the histories updated before warn_before but not delete_before, and of those updated before delete_before
+  if numpy is not None:
+    delete_mask = times < delete_before
+    return numpy.flatnonzero((times < warn_before) & ~delete_mask), numpy.flatnonzero(delete_mask)
   warn_ret = []
   delete_ret = []
-  for history in histories:
-    ut = history['update_time']
-    if ut < wt:
-      if ut < dt:
-        delete_ret.append(history)
+  for i, ut in enumerate(times):
+    if ut < warn_before:
+      if ut < delete_before:
+        delete_ret.append(i)
       else:
-        warn_ret.append(history)
-
+        warn_ret.append(i)
   return warn_ret, delete_ret
 
+def total_size(sizes, indices):
+  if numpy is not None:
+    return float(sizes[indices].sum())
+  return sum(sizes[i] for i in indices)
+
+def add_storage_by_age(times, sizes, now, bucket_days, buckets):
+  # Adds the bytes and number of histories in each age bucket to buckets. A bucket is keyed on the age in days since
+  # the history was last updated, rounded down to a multiple of bucket_days.
+  bucket = bucket_days * 86400 * 10**6
+  now = to_microseconds(now)
+  if numpy is not None:
+    ages, inverse = numpy.unique((now - times) // bucket * bucket_days, return_inverse=True)
+    bytes_by_age = numpy.bincount(inverse, weights=sizes, minlength=len(ages))
+    count_by_age = numpy.bincount(inverse, minlength=len(ages))
+    for age, age_bytes, age_count in zip(ages.tolist(), bytes_by_age.tolist(), count_by_age.tolist()):
+      totals = buckets.setdefault(age, [0.0, 0])
+      totals[0] += age_bytes
+      totals[1] += age_count
+    return buckets
+  for ut, size in zip(times, sizes):
+    totals = buckets.setdefault((now - ut) // bucket * bucket_days, [0.0, 0])
+    totals[0] += size
+    totals[1] += 1
+  return buckets
+
+def group_by_user(histories, groups=None):
+  if groups is None:
+    groups = {}
+  for history in histories:
+    uid = history['user_id']
+    if uid in groups:
+      groups[uid].append(history)
+    else:
+      groups[uid] = [history]
+  return groups
+
+def group_histories(history_pages, warn_days, delete_days, bucket_days=None):
+  # Classify pages of histories as they arrive, grouping warnable and delete eligible histories per user.
+  # Only the current page and the per user groups are held, so pages may come from a generator.
+  # Each page is split and totalled on its update_time and size columns, which also feed the storage by age report,
+  # in buckets of bucket_days (STORAGE_REPORT_BUCKET_DAYS by default).
+  if bucket_days is None:
+    bucket_days = getattr(config, 'STORAGE_REPORT_BUCKET_DAYS', 30)
+  now = galaxy_now()
+  warn_before = to_microseconds(now - timedelta(days=warn_days))
+  delete_before = to_microseconds(now - timedelta(days=delete_days))
+  warn_groups = {}
+  delete_groups = {}
+  totals = {'warn': 0, 'warn_size': 0.0, 'delete': 0, 'delete_size': 0.0, 'by_age': {}}
+
+  for page in history_pages:
+    if page is None:
+      return None
+
+    times, sizes = history_columns(page)
+    warn_indices, delete_indices = split_by_age(times, warn_before, delete_before)
+    group_by_user([page[i] for i in warn_indices], warn_groups)
+    group_by_user([page[i] for i in delete_indices], delete_groups)
+    totals['warn'] += len(warn_indices)
+    totals['warn_size'] += total_size(sizes, warn_indices)
+    totals['delete'] += len(delete_indices)
+    totals['delete_size'] += total_size(sizes, delete_indices)
+    add_storage_by_age(times, sizes, now, bucket_days, totals['by_age'])
+
+  return warn_groups, delete_groups, totals
+
+def storage_age_report(by_age):
+  # For each age bucket, the storage a threshold at that age would reclaim: every scanned history at least that old
+  ages = sorted(by_age, reverse=True)
+  culm_bytes = culm_days({age: by_age[age][0] for age in ages})
+  culm_histories = culm_days({age: by_age[age][1] for age in ages})
+  report = {}
+  print("Reclaimable storage by days since last update:")
+  for age in reversed(ages):
+    report[age] = {'bytes': culm_bytes[age], 'histories': int(culm_histories[age])}
+    print(f"  {age} days or more: {sizeof_fmt(culm_bytes[age])} in {int(culm_histories[age])} histories")
+  return report
+
 def culm_days(days):
   culm_size = 0.0
   ret = {}
@@ -106,14 +557,8 @@ def sizeof_fmt(num, suffix='B'):
     num /= 1024.0
   return "%.1f%s%s" % (num, 'Yi', suffix)
 
-def culminate_histories_size(histories):
-  history_bytes = 0.0
-  for history in histories:
-    history_bytes += history['size']
-  return history_bytes
-
-def process_size(histories, label="delete eligible"):
-  ret = "Total space used by " + label + " histories: " + sizeof_fmt(culminate_histories_size(histories))
+def process_size(history_bytes, label="delete eligible"):
+  ret = "Total space used by " + label + " histories: " + sizeof_fmt(history_bytes)
   print(ret)
   return ret
 
@@ -133,7 +578,21 @@ def get_user_details(user_id):
   ret.pop('preferences', None)
   return ret
 
-def add_user_groups(users):
+def iter_user_details(user_ids, workers=None):
+  # Yields (user_id, details) in the order given, looking up to `workers` (GALAXY_USER_WORKERS by default) users up
+  # concurrently. A user id of None has no details and is never queried.
+  if workers is None:
+    workers = getattr(config, 'GALAXY_USER_WORKERS', 1)
+
+  def lookup(uid):
+    if uid is None:
+      return None
+    return get_user_details(uid)
+
+  return zip(user_ids, iter_ordered(lookup, user_ids, workers))
+
+def get_group_members(group_name):
+  # Returns the set of user ids in the named group, an empty set if there is no such group, or None on error
   global GALAXY_BASEURL
   global GALAXY_API_KEY
 
@@ -142,33 +601,86 @@ def add_user_groups(users):
 
   if res.status_code != 200:
     print("ERROR: Request did not return ok: " + res.reason + ': ' + res.text)
-    return False
+    return None
 
-  groups = res.json()
-  group_i = 0
-  start=time()
-  for group in groups:
-    group_i += 1
-    sys.stdout.write("Populating group: " + group['name'] + " (" + str(group_i) + "/" + str(len(groups)) + ")   \r")
-    sys.stdout.flush()
+  members = set()
+  for group in res.json():
+    if group['name'] != group_name:
+      continue
     queryURL = GALAXY_BASEURL + config.GALAXY_GROUP_EP + group['id'] + config.GALAXY_GROUP_USER_EP
     res=session.get(queryURL+'?key='+ GALAXY_API_KEY)
 
     if res.status_code != 200:
       print("ERROR: Request did not return ok: " + res.reason + ': ' + res.text)
-      return False
+      return None
 
-    group_users = res.json()
+    members.update(user['id'] for user in res.json())
 
-    for user in group_users:
-      if user['id'] in users.keys():
-        if 'groups' in users[user['id']]['details'].keys():
-          users[user['id']]['details']['groups'].append(group)
-        else:
-          users[user['id']]['details']['groups'] = [group]
+  return members
 
-  print(str(len(groups)) + " groups queried. Total query time: " + str(timedelta(seconds=time()-start)))
-  return
+def get_keeplist_members():
+  # Members of config.GALAXY_KEEPLIST_GROUP, fetched once per process. With GALAXY_KEEPLIST_CACHE_HOURS set, the
+  # member list is also kept in the local database and reused by later runs until it is older than that.
+  global KEEPLIST_MEMBERS
+  global GALAXY_BASEURL
+  global Session
+
+  if KEEPLIST_MEMBERS is not None:
+    return KEEPLIST_MEMBERS
+
+  ttl = getattr(config, 'GALAXY_KEEPLIST_CACHE_HOURS', 0)
+  db_session = Session() if ttl > 0 else None
+  if db_session is not None:
+    cached = db_session.query(KeeplistMember).filter_by(server=GALAXY_BASEURL).all()
+    if len(cached) > 0 and min(m.fetched for m in cached) > datetime.now() - timedelta(hours=ttl):
+      KEEPLIST_MEMBERS = set(m.user_id for m in cached)
+      db_session.close()
+      print(str(len(KEEPLIST_MEMBERS)) + " keeplisted users loaded from local cache.")
+      return KEEPLIST_MEMBERS
+
+  members = get_group_members(config.GALAXY_KEEPLIST_GROUP)
+  if members is None:
+    print("ERROR: Unable to fetch keeplist group members. No users will be treated as keeplisted.")
+    if db_session is not None:
+      db_session.close()
+    return set()
+
+  if db_session is not None:
+    fetched = datetime.now()
+    db_session.query(KeeplistMember).filter_by(server=GALAXY_BASEURL).delete()
+    for uid in members:
+      member = KeeplistMember()
+      member.server = GALAXY_BASEURL
+      member.user_id = uid
+      member.fetched = fetched
+      db_session.add(member)
+    db_session.commit()
+    db_session.close()
+
+  KEEPLIST_MEMBERS = members
+  print(str(len(members)) + " keeplisted users.")
+  return KEEPLIST_MEMBERS
+
+def load_template_source(template_file):
+  # Template names are file paths, relative to the working directory as in config.MAIL_TEMPLATE_*
+  path = os.path.abspath(template_file)
+  mtime = os.path.getmtime(path)
+  with open(path) as f:
+    source = f.read()
+  return source, path, lambda: os.path.getmtime(path) == mtime
+
+def get_template(template_file):
+  # Compile each mail template once per process through a shared Environment. With MAIL_TEMPLATE_CACHE_DIR set,
+  # compiled templates are also kept on disk so later runs skip the compile step.
+  global TEMPLATE_ENV
+  if TEMPLATE_ENV is None:
+    cache_dir = getattr(config, 'MAIL_TEMPLATE_CACHE_DIR', '')
+    bytecode_cache = None
+    if cache_dir:
+      os.makedirs(cache_dir, exist_ok=True)
+      bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    TEMPLATE_ENV = Environment(loader=FunctionLoader(load_template_source), bytecode_cache=bytecode_cache, auto_reload=False)
+  return TEMPLATE_ENV.get_template(template_file)
 
 def send_email(to=[], html="", subject=config.MAIL_SUBJECT_WARNING, from_address=config.MAIL_FROM, replyto=config.MAIL_REPLYTO, production=False):
   if len(to) == 0:
@@ -203,6 +715,57 @@ def send_email(to=[], html="", subject=config.MAIL_SUBJECT_WARNING, from_address
 
   return res.json()
 
+def wait_for_send_slot(rate):
+  # Spaces sends across all delivery workers to at most `rate` messages per second
+  global MAIL_NEXT_SEND
+  if rate <= 0:
+    return
+  with MAIL_RATE_LOCK:
+    now = time()
+    slot = max(now, MAIL_NEXT_SEND)
+    MAIL_NEXT_SEND = slot + 1.0 / rate
+  if slot > now:
+    sleep(slot - now)
+
+def deliver_email(details, html, subject, production=False):
+  # Returns (time sent, Postal results). Results are None if the email could not be sent at all, e.g. no address.
+  wait_for_send_slot(getattr(config, 'MAIL_SEND_RATE', 0))
+  try:
+    msg_results = send_email(to=[details['email']], html=html, subject=subject, production=production)
+  except:
+    msg_results = None
+  return datetime.now(), msg_results
+
+def record_notification(db_session, user, n_type, sent, msg_results):
+  # Adds a notification whether or not the send succeeded, flushed so its id is assigned, in the caller's
+  # transaction. Returns (notification id, accepted by Postal).
+  notification = Notification()
+  notification.user_id = user
+  notification.type = n_type
+  notification.sent = sent
+  accepted = False
+
+  try:
+    notification.status = msg_results['status']
+    if notification.status == "success":
+      notification.message_id = msg_results['data']['message_id']
+      message = Message()
+      message.message_id = msg_results['data']['message_id']
+      message.status = "Accepted"
+      db_session.add(message)
+      notification.message = message
+      accepted = True
+    else:
+      print("ERROR: Postal did not return as success:", msg_results)
+
+  except:
+    print("ERROR: Unable to send notification: no email for user:", user)
+    notification.status = "Unable to send"
+
+  db_session.add(notification)
+  db_session.flush()
+  return notification.id, accepted
+
 def remove_history(history, purge=False):
   global GALAXY_BASEURL; global GALAXY_API_KEY
 
@@ -211,488 +774,1160 @@ def remove_history(history, purge=False):
   res=session.delete(queryURL)
   return res.status_code == 200
 
-def get_users_details(user_ids, histories):
-    #Given a set of user ids, return a dictionary of user details for each with their associated histories
+def load_cached_users(db_session, user_ids, ttl_hours, chunk_size=500):
+  # Details of the users in user_table that were fetched from Galaxy within ttl_hours, keyed on user id
+  fresh = datetime.now() - timedelta(hours=ttl_hours)
+  keys = [attr.key for attr in User.__mapper__.column_attrs if attr.key not in ('uid', 'refreshed')]
+  cached = {}
+  user_ids = [uid for uid in user_ids if uid is not None]
+  for i in range(0, len(user_ids), chunk_size):
+    for user in db_session.query(User).filter(User.id.in_(user_ids[i:i+chunk_size]), User.refreshed > fresh):
+      cached[user.id] = {key: getattr(user, key) for key in keys}
+  return cached
+
+def resolve_users(user_ids):
+    #Given user ids, return a dictionary of the details of each, or False for users without details. Each user is looked up
+    #once however many of the run's phases they appear in, and users fetched from Galaxy are stored in user_table.
+    #With GALAXY_USER_CACHE_HOURS set, users refreshed within that many hours are served from user_table instead of Galaxy
     global Session
-    global NULL_USER_DETAILS
 
     print("Building user information")
-    users = {}
-    bad_users = {}
+    details = {}
     user_count = 0
     start=time()
     db_session = Session()
+    ttl = getattr(config, 'GALAXY_USER_CACHE_HOURS', 0)
+    cached = load_cached_users(db_session, user_ids, ttl) if ttl > 0 else {}
+    fetched = iter_user_details([uid for uid in user_ids if uid not in cached])
+    refreshed = datetime.now()
     for uid in user_ids:
-      user = {}
-      user['histories'] = []
-      if uid is None:
-        details = None
+      if uid in cached:
+        details[uid] = cached[uid]
       else:
-        details = get_user_details(uid)
-
-      if details:
-        u_model = db_session.query(User).filter_by(id=details['id']).first()
-        if u_model is None:
-          db_session.add(User(details))
-          db_session.commit()
-        else:
-          u_model.update(details)
-          db_session.add(u_model)
-          db_session.commit()
-        user['details'] = details
-        users[uid] = user
-      else:
-        user['details'] = NULL_USER_DETAILS
-        bad_users[uid] = user
+        _, details[uid] = next(fetched)
 
       if user_count % 100 == 0:
         sys.stdout.write("Users queried: " + str(user_count) + "/" + str(len(user_ids)) + "   \r")
         sys.stdout.flush()
       user_count += 1
 
-    print(str(len(users)) + " users queried. Total query time: " + str(timedelta(seconds=time()-start)))
+    bulk_upsert(db_session, User, (details[uid] for uid in user_ids if details[uid] and uid not in cached), values={'refreshed': refreshed})
+    db_session.commit()
+    db_session.close()
+    if ttl > 0:
+      print(str(len(cached)) + " users loaded from local cache.")
+    print(str(len([uid for uid in user_ids if details[uid]])) + " users queried. Total query time: " + str(timedelta(seconds=time()-start)))
+    return details
+
+def get_users_details(user_histories, details=None):
+    #Given a dictionary of user ids to histories, return a dictionary of user details for each with their associated histories
+    #The details are looked up with resolve_users unless given, as resolved for all of the run's phases at once
+    global Session
+    global NULL_USER_DETAILS
+
+    if details is None:
+      details = resolve_users(list(user_histories))
+    users = {}
+    bad_users = {}
+    for uid in user_histories:
+      user = {}
+      user['histories'] = user_histories[uid]
 
-    print("Processing histories with user data")
-    history_count = 0
-    start=time()
-    for history in histories:
-      uid = history['user_id']
-      if uid in users.keys():
-        users[uid]['histories'].append(history)
-      elif uid in bad_users.keys():
-        bad_users[uid]['histories'].append(history)
-
-      h_model = db_session.query(History).filter_by(id=history['id']).first() #concurrency here
-      if h_model is None:
-        db_session.add(History(history))
-        db_session.commit()
+      if details[uid]:
+        user['details'] = details[uid]
+        users[uid] = user
       else:
-        h_model.update(history)
-        db_session.add(h_model)
-        db_session.commit()
-      if history_count % 100 == 0:
-        sys.stdout.write("Histories processed: " + str(history_count) + "/" + str(len(histories)) + "   \r")
-        sys.stdout.flush()
-      history_count += 1
+        user['details'] = NULL_USER_DETAILS
+        bad_users[uid] = user
 
-    print(str(len(histories)) + " histories processed. Total time: " + str(timedelta(seconds=time()-start)))
+    print("Processing histories with user data")
+    start=time()
+    db_session = Session()
+    history_total = bulk_upsert(db_session, History, (history for uid in user_histories for history in user_histories[uid]))
+    db_session.commit()
+    print(str(history_total) + " histories processed. Total time: " + str(timedelta(seconds=time()-start)))
 
-    add_user_groups(users) # need to process bad_users groups too?
     db_session.close()
 
     return users, bad_users
 
+def run_user_ids(warn_groups, delete_groups):
+  # The users of both phases of a run, each once, for resolve_users
+  return list(warn_groups) + [uid for uid in delete_groups if uid not in warn_groups]
+
+
+def load_notification_index(db_session, history_ids, chunk_size=500):
+  # Map (history_id, h_date) to the (sent, type) of each linked notification, oldest link first, using one joined
+  # query per chunk of history ids. A link whose notification row is missing is kept as (None, None).
+  index = {}
+  history_ids = list(history_ids)
+  for i in range(0, len(history_ids), chunk_size):
+    rows = db_session.query(HistoryNotification.h_id, HistoryNotification.h_date, Notification.sent, Notification.type) \
+      .outerjoin(Notification, Notification.id == HistoryNotification.n_id) \
+      .filter(HistoryNotification.h_id.in_(history_ids[i:i+chunk_size])) \
+      .order_by(HistoryNotification.id)
+    for h_id, h_date, sent, n_type in rows:
+      key = (h_id, h_date)
+      if key in index:
+        index[key].append((sent, n_type))
+      else:
+        index[key] = [(sent, n_type)]
+  return index
 
-def eligible_history(history, default_for_null=True):
+def eligible_history(history, default_for_null=True, notification_index=None):
   global Session
-  db_session = Session()
   ret = True
   warn_threshold = datetime.now() - timedelta(days=config.EMAIL_DAYS_THRESHOLD)
 
-  notifications = db_session.query(HistoryNotification).filter_by(h_id=history['id'], h_date=history['update_time']).all()
+  if notification_index is None:
+    db_session = Session()
+    notification_index = load_notification_index(db_session, [history['id']])
+    db_session.close()
+  notifications = notification_index.get((history['id'], history['update_time']), [])
 
   if len(notifications) == 0:
-    db_session.close()
     return default_for_null
 
-  for n in notifications:
-    notification = db_session.query(Notification).filter_by(id=n.n_id).first()
-
-    if notification is not None:
-      if notification.sent > warn_threshold:
+  for sent, n_type in notifications:
+    if sent is not None:
+      if sent > warn_threshold:
         ret = False
-      if notification.type == "Deletion": #always skip histories that have been notified as being deleted previously.
+      if n_type == "Deletion": #always skip histories that have been notified as being deleted previously.
         print(f"ERROR: History {history['id']} already notified regarding deletion, but is presented for processing. Check past logs/db for details. Manual deletion required. Skipping.")
         ret = False
 
-  db_session.close()
   return ret
 
 
-def run(histories, dryrun=True, do_delete=False, force=False, production=False):
+def select_user_warnings(user_histories, notification_index, force=False):
+  # Returns the histories of one user to warn about, with their deletion dates set, and the number skipped
+  histories = []
+  skipped = 0
+  for i, h in enumerate(user_histories):
+    if force or eligible_history(h, notification_index=notification_index):
+      del_date = datetime.now()
+
+      notifications = notification_index.get((h['id'], h['update_time']))
+      if notifications:
+        first_sent = notifications[0][0]
+        if first_sent is None:
+          ## TODO setup error check here. Really shouldn't get here unless there's manual db edits
+          print("Error looking up notifcation. Defaulting to base date.")
+        else:
+          del_date = first_sent
+      h.del_date = del_date + timedelta(days=(config.HISTORIES_DELETE_DAYS-config.HISTORIES_WARN_DAYS))
+      histories.append(h)
+    else:
+      skipped += 1
+  return histories, skipped
+
+def select_user_deletions(user_histories, notification_index, force=False):
+  # Returns the histories of one user to delete and the number skipped
+  histories = []
+  skipped = 0
+  for i, h in enumerate(user_histories):
+    if force or eligible_history(h, False, notification_index): # requires user to have been warned about the history at least once and at least the configured days ago
+      histories.append(h)
+    else:
+      skipped += 1
+      # TODO once code is neater, send warning message about such histories here
+      # TODO change order so that the deletion api is called first and then email sent on successful deletion
+  return histories, skipped
+
+def user_display_name(details):
+  try:
+    return details['username']
+  except:
+    return "Galaxy User"
+
+def new_counts():
+  return dict(histories=0, skipped_histories=0, skipped_users=0, keeplisted_users=0)
+
+def add_counts(counts, changes):
+  for key in changes:
+    counts[key] += changes[key]
+
+def select_user(user, user_histories, details, keeplist, select, notification_index, force=False, dryrun=True):
+  # Selects one user's histories with select (select_user_warnings or select_user_deletions), as run(), the shards
+  # and the pipeline all do. Returns the (user, username, details, histories) job to send, or None, and the changes
+  # to the selection counts. Nothing is selected for sending on a dry run, but the counts are still made.
+  if user in keeplist:
+    return None, dict(keeplisted_users=1)
+
+  histories, skipped = select(user_histories, notification_index, force)
+  changes = dict(histories=len(histories), skipped_histories=skipped)
+  if len(histories) == 0:
+    # user has no histories to warn about or delete. Skip
+    changes['skipped_users'] = 1
+    return None, changes
+
+  # skip sending code if dryrun
+  if dryrun:
+    return None, changes
+
+  return (user, user_display_name(details), details, histories), changes
+
+def select_jobs(users, keeplist, select, notification_index, force=False, dryrun=True, label="Users"):
+  counts = new_counts()
+  jobs = []
+  for processed_users, user in enumerate(users):
+    if processed_users % 100 == 0:
+      sys.stdout.write(label + " processed: " + str(processed_users) + "/" + str(len(users)) + "   \r")
+      sys.stdout.flush()
+    job, changes = select_user(user, users[user]['histories'], users[user]['details'], keeplist, select, notification_index, force, dryrun)
+    add_counts(counts, changes)
+    if job is not None:
+      jobs.append(job)
+  return jobs, counts
+
+def select_warnings(warn_users, keeplist, notification_index, force=False, dryrun=True):
+  # Returns the (user, username, details, histories) warnings to send and the selection counts
+  return select_jobs(warn_users, keeplist, select_user_warnings, notification_index, force, dryrun, "Warnings")
+
+def select_deletions(delete_users, keeplist, notification_index, force=False, dryrun=True):
+  # Returns the (user, username, details, histories) deletions to make and the selection counts
+  return select_jobs(delete_users, keeplist, select_user_deletions, notification_index, force, dryrun, "Deletions")
+
+def open_run_journal(db_session, do_delete):
+  # An unfinished run left on this server is superseded, since this run scanned and selected its histories again
   global GALAXY_BASEURL
-  global GALAXY_API_KEY
-  global GALAXY_HIST_VIEW_BASE
-  global Session
+  now = datetime.now()
+  db_session.query(RunJournal).filter_by(server=GALAXY_BASEURL, status="Running") \
+    .update({RunJournal.status: "Superseded", RunJournal.finished: now}, synchronize_session=False)
+
+  journal = RunJournal()
+  journal.server = GALAXY_BASEURL
+  journal.do_delete = do_delete
+  journal.started = now
+  journal.status = "Running"
+  db_session.add(journal)
+  db_session.commit()
+  return journal.id
+
+def add_journal_entries(db_session, run_id, phase, position, job):
+  user, username, details, histories = job
+  db_session.bulk_insert_mappings(RunJournalEntry, [dict(run_id=run_id, phase=phase, position=position, user_id=user, \
+    history_id=h['id'], h_date=h['update_time'], del_date=h.del_date) for h in histories])
+
+def journal_jobs(db_session, run_id, to_warn, to_delete):
+  for phase, jobs in [("Warning", to_warn), ("Deletion", to_delete)]:
+    for position, job in enumerate(jobs):
+      add_journal_entries(db_session, run_id, phase, position, job)
+  db_session.commit()
+
+def start_run_journal(db_session, do_delete, to_warn, to_delete):
+  # Record the work list of a run before anything is sent so that an interrupted run can be continued with --resume
+  run_id = open_run_journal(db_session, do_delete)
+  journal_jobs(db_session, run_id, to_warn, to_delete)
+  return run_id
+
+def mark_user_notified(db_session, run_id, phase, user):
+  # Flagged in the caller's transaction, so the progress is committed together with the user's notification
+  if run_id is None:
+    return
+  db_session.query(RunJournalEntry).filter_by(run_id=run_id, phase=phase, user_id=user) \
+    .update({RunJournalEntry.status: "Notified"}, synchronize_session=False)
+
+def set_deletion_status(db_session, run_id, history_ids, status):
+  if run_id is None:
+    return
+  for i in range(0, len(history_ids), 500):
+    db_session.query(RunJournalEntry).filter(RunJournalEntry.run_id == run_id, RunJournalEntry.phase == "Deletion", \
+      RunJournalEntry.history_id.in_(history_ids[i:i+500])).update({RunJournalEntry.status: status}, synchronize_session=False)
+  db_session.commit()
+
+def finish_run_journal(db_session, run_id):
+  if run_id is None:
+    return
+  db_session.query(RunJournal).filter_by(id=run_id) \
+    .update({RunJournal.status: "Complete", RunJournal.finished: datetime.now()}, synchronize_session=False)
+  db_session.commit()
+
+def load_run_journal(db_session, journal):
+  # Rebuild the unfinished work of a journalled run from its entries, the local history mirror and user_table.
+  # Returns the pending warnings and deletions in their original order, and the histories of users already
+  # notified of deletion whose deletion was not confirmed. Histories and users are joined one row per Galaxy id, as
+  # older databases may hold duplicate rows (see the lookup indexes migration).
+  entries = select(RunJournalEntry.history_id, RunJournalEntry.user_id).where(RunJournalEntry.run_id == journal.id)
+  histories = db_session.query(History.id, func.max(History.name).label('name'), func.max(History.size).label('size')) \
+    .filter(History.id.in_(entries.with_only_columns(RunJournalEntry.history_id))).group_by(History.id).subquery()
+  users = db_session.query(User.id, func.max(User.username).label('username'), func.max(User.email).label('email')) \
+    .filter(User.id.in_(entries.with_only_columns(RunJournalEntry.user_id))).group_by(User.id).subquery()
+  rows = db_session.query(RunJournalEntry, histories.c.name, histories.c.size, users.c.username, users.c.email) \
+    .outerjoin(histories, histories.c.id == RunJournalEntry.history_id) \
+    .outerjoin(users, users.c.id == RunJournalEntry.user_id) \
+    .filter(RunJournalEntry.run_id == journal.id) \
+    .order_by(RunJournalEntry.position, RunJournalEntry.id)
+
+  jobs = {"Warning": {}, "Deletion": {}}
+  pending_deletions = []
+  for entry, name, size, username, email in rows:
+    if entry.status == "Notified" and entry.phase == "Deletion":
+      pending_deletions.append(entry.history_id)
+    if entry.status is not None:
+      continue
+
+    h = HistoryRecord({'id': entry.history_id, 'name': name, 'size': size or 0.0, 'update_time': entry.h_date, 'user_id': entry.user_id})
+    h.del_date = entry.del_date
+
+    job = jobs[entry.phase].get(entry.user_id)
+    if job is None:
+      details = {'username': username}
+      if email:
+        details['email'] = email
+      job = (entry.user_id, username or "Galaxy User", details, [])
+      jobs[entry.phase][entry.user_id] = job
+    job[3].append(h)
+
+  return list(jobs["Warning"].values()), list(jobs["Deletion"].values()), pending_deletions
+
+def set_render_context():
+  # The mail template values shared by every email of a run, built once when main() has selected the server
+  global RENDER_CONTEXT
+  warn_weeks = int(int(config.HISTORIES_WARN_DAYS)/7)
+  delete_weeks = int(int(config.HISTORIES_DELETE_DAYS)/7)
+  RENDER_CONTEXT = {
+    "Warning": dict(warn_weeks = warn_weeks, delete_weeks = delete_weeks, warn_period = str(config.EMAIL_DAYS_THRESHOLD), hist_view_base = GALAXY_HIST_VIEW_BASE),
+    "Deletion": dict(delete_weeks = delete_weeks, hist_view_base = GALAXY_HIST_VIEW_BASE),
+  }
+
+def render_warning(username, histories):
+  return get_template(config.MAIL_TEMPLATE_WARNING).render(RENDER_CONTEXT["Warning"], username = username, histories = histories)
+
+def render_deletion(username, histories):
+  return get_template(config.MAIL_TEMPLATE_DELETION).render(RENDER_CONTEXT["Deletion"], username = username, histories = histories)
+
+def send_warning(job, production=False):
+  user, username, details, histories = job
+  return deliver_email(details, render_warning(username, histories), config.MAIL_SUBJECT_WARNING, production)
+
+def send_deletion(job, production=False):
+  user, username, details, histories = job
+  return deliver_email(details, render_deletion(username, histories), config.MAIL_SUBJECT_DELETION, production)
+
+def record_user_notification(db_session, run_id, n_type, user, histories, sent, msg_results):
+  # Records a sent warning or deletion email, linking it to each of the user's histories, and flags the user's
+  # progress in the run journal, all in one transaction. Returns whether Postal accepted the email.
+  mark_user_notified(db_session, run_id, n_type, user)
+  notification_id, accepted = record_notification(db_session, user, n_type, sent, msg_results)
+  db_session.bulk_insert_mappings(HistoryNotification, [dict(h_id=h['id'], h_date=h['update_time'], n_id=notification_id) for h in histories])
+  db_session.commit()
+  return accepted
+
+def send_warnings(db_session, to_warn, production=False, run_id=None):
+  # Send the selected warnings, recording each notification in order as its result comes back.
+  # Returns the number of users emailed and the number that could not be.
+  emailed_users = 0
+  error_users = 0
+  if len(to_warn) == 0:
+    return emailed_users, error_users
+
+  get_template(config.MAIL_TEMPLATE_WARNING)
+  send = lambda job: send_warning(job, production)
+  for (user, username, details, histories), (sent, msg_results) in zip(to_warn, iter_ordered(send, to_warn, getattr(config, 'MAIL_SEND_WORKERS', 1))):
+    accepted = record_user_notification(db_session, run_id, "Warning", user, histories, sent, msg_results)
+    if accepted:
+      emailed_users += 1
+    else:
+      error_users += 1
+
+  return emailed_users, error_users
+
+def collect_deletions(db_session, run_id, deletions):
+  # Waits for submitted (history id, future) deletions and records their results in the run journal.
+  # Returns the number of histories deleted and the number that failed.
+  deleted = []
+  failed = []
+  for history_id, deletion in deletions:
+    if deletion.result():
+      deleted.append(history_id)
+    else:
+      failed.append(history_id)
+      print(f"ERROR: Unable to delete history {history_id}")
+
+  set_deletion_status(db_session, run_id, deleted, "Deleted")
+  set_deletion_status(db_session, run_id, failed, "Failed")
+  return len(deleted), len(failed)
+
+def send_deletions(db_session, to_delete, production=False, run_id=None, pending_deletions=[]):
+  # Send the selected deletion emails and delete each user's histories once their notifications are recorded.
+  # Histories in pending_deletions were notified by an interrupted run and are only deleted.
+  # Returns the number of users emailed, users that could not be, histories deleted and histories that failed.
+  emailed_users = 0
+  error_users = 0
+  mail_workers = getattr(config, 'MAIL_SEND_WORKERS', 1)
+  if len(to_delete) > 0:
+    get_template(config.MAIL_TEMPLATE_DELETION)
+
+  # histories are deleted on their own pool while the remaining emails are sent and recorded
+  delete_workers = getattr(config, 'GALAXY_DELETE_WORKERS', 1)
+  set_http_pool_size(mail_workers + delete_workers)
+  delete_executor = ThreadPoolExecutor(max_workers=delete_workers)
+  deletions = [(history_id, delete_executor.submit(remove_history, history_id, False)) for history_id in pending_deletions]
+
+  #send the deletion emails, recording each notification in order as its result comes back
+  send = lambda job: send_deletion(job, production)
+  for (user, username, details, histories), (sent, msg_results) in zip(to_delete, iter_ordered(send, to_delete, mail_workers)):
+    accepted = record_user_notification(db_session, run_id, "Deletion", user, histories, sent, msg_results)
+    if accepted:
+      emailed_users += 1
+    else:
+      error_users += 1
+
+    #Actually do the deletion, now that the history notifications are recorded
+    for h in histories:
+      deletions.append((h['id'], delete_executor.submit(remove_history, h['id'], False)))
+
+  delete_executor.shutdown(wait=True)
+  deleted_histories, error_histories = collect_deletions(db_session, run_id, deletions)
+  return emailed_users, error_users, deleted_histories, error_histories
+
+def warning_msgs(counts, emailed_users, error_users):
   msgs = []
-  warn_users = []
-  bad_users = []
-  delete_users = []
-  bad_delete_users = []
+  msgs.append(f"{counts['histories']} histories eligible for warning, {counts['skipped_histories']} histories skipped.")
+  msgs.append(f"{emailed_users} users eligible for warning, {counts['skipped_users']} users skipped.")
+  if counts['keeplisted_users'] > 0:
+    msgs.append(f"{counts['keeplisted_users']} users were excluded due to keeplisting.")
+  if error_users > 0:
+    msgs.append(f"{error_users} users had error sending warning notification. Check logs/db for more details.")
+  for msg in msgs:
+    print(msg)
+  return msgs
 
-  warn_histories, delete_histories = filter_histories_update_time(histories, config.HISTORIES_WARN_DAYS, config.HISTORIES_DELETE_DAYS)
+def deletion_msgs(counts, emailed_users, error_users, deleted_histories, error_histories):
+  msgs = []
+  msgs.append(f"{counts['histories']} histories eligible for deletion, {deleted_histories} histories deleted.")
+  msgs.append(f"{emailed_users} users notified regarding deletion.")
+  if counts['keeplisted_users'] > 0:
+    msgs.append(f"{counts['keeplisted_users']} users were excluded due to keeplisting.")
+  if error_histories > 0:
+    msgs.append(f"{error_histories} failed to be deleted. Check logs/db for more details. Manual intervention required.")
+  if counts['skipped_histories'] > 0:
+    msgs.append(f"{counts['skipped_histories']} histories skipped for deletion due to no prior warning notifications, insufficient time between warning and deletion, or failed to be deleted previously. Check logs/db for more details.")
+  if counts['skipped_users'] > 0:
+    msgs.append(f"{counts['skipped_users']} users skipped for notification due to having all skipped histories.")
+  if error_users > 0:
+    msgs.append(f"{error_users} users had error sending deletion notification. Check logs/db for more details.")
+  for msg in msgs:
+    print(msg)
+  return msgs
 
-  msg = str(len(warn_histories)) + " histories selected for warning"
+def run_msgs(totals, do_delete, delete_groups, bad_users, bad_delete_users, warn_counts, warn_results, delete_counts, delete_results):
+  # The closing messages of run(), run_pipeline and run_sharded. warn_results are the emailed and error users of
+  # the warnings, delete_results those of the deletions followed by the deleted and failed histories.
+  msgs = []
+  if len(bad_users) > 0:
+    msg = str(len(bad_users)) + " warnable users without details. Skipping."
+    msgs.append(msg)
+    print(msg)
+  msgs.extend(warning_msgs(warn_counts, *warn_results))
+
+  if do_delete:
+    if len(delete_groups) < 1:
+      msg = "No user histories require deletion."
+      msgs.append(msg)
+      print(msg)
+    else:
+      msg = str(len(delete_groups)) + " unique users for deletion of " + str(totals['delete']) + " histories."
+      msgs.append(msg)
+      print(msg)
+      if len(bad_delete_users) > 0:
+        msg = str(len(bad_delete_users)) + " delete eligible users without details. Skipping."
+        msgs.append(msg)
+        print(msg)
+      msgs.extend(deletion_msgs(delete_counts, *delete_results))
+  return msgs
+
+
+def report_groups(warn_groups, delete_groups, totals, do_delete, msgs):
+  # Reports the classified scan in msgs. Unless deleting, delete eligible histories are warned about instead.
+  # Returns the warn and delete groups to act on.
+  msg = str(totals['warn']) + " histories selected for warning"
   msgs.append(msg)
   print(msg)
-  process_size(warn_histories, "warnable")
+  process_size(totals['warn_size'], "warnable")
 
-  msg = str(len(delete_histories)) + " histories selected for deletion"
+  msg = str(totals['delete']) + " histories selected for deletion"
   msgs.append(msg)
   print(msg)
-  process_size(delete_histories, "delete eligible")
+  process_size(totals['delete_size'], "delete eligible")
+  metrics.set_info('storage_by_age', storage_age_report(totals['by_age']))
 
   if not do_delete:
-    warn_histories += delete_histories
+    for uid in delete_groups:
+      if uid in warn_groups:
+        warn_groups[uid].extend(delete_groups[uid])
+      else:
+        warn_groups[uid] = delete_groups[uid]
+    delete_groups = {}
     msg = "Not deleting histories. Delete eligible histories will be warned instead."
     msgs.append(msg)
     print(msg)
 
-  user_ids = set()
-  for history in warn_histories:
-    user_ids.add(history['user_id'])
-
-  msg=str(len(user_ids)) + " unique users for warning."
+  msg=str(len(warn_groups)) + " unique users for warning."
   msgs.append(msg)
   print(msg)
+  return warn_groups, delete_groups
 
-  warn_users, bad_users = get_users_details(user_ids, warn_histories)
-
-  if len(bad_users) > 0:
-    msg = str(len(bad_users)) + " warnable users without details. Skipping."
-    msgs.append(msg)
-    print(msg)
+def run(history_pages, dryrun=True, do_delete=False, force=False, production=False):
+  global GALAXY_BASEURL
+  global GALAXY_API_KEY
+  global GALAXY_HIST_VIEW_BASE
+  global Session
+  msgs = []
+  warn_users = []
+  bad_users = []
+  delete_users = []
+  bad_delete_users = []
 
-  # process warnings
-  warn_weeks = int(int(config.HISTORIES_WARN_DAYS)/7)
-  delete_weeks = int(int(config.HISTORIES_DELETE_DAYS)/7)
+  with metrics.stage('classify_histories'):
+    grouped = group_histories(history_pages, config.HISTORIES_WARN_DAYS, config.HISTORIES_DELETE_DAYS)
+  if grouped is None:
+    return None, msgs
+  warn_groups, delete_groups, totals = grouped
+  warn_groups, delete_groups = report_groups(warn_groups, delete_groups, totals, do_delete, msgs)
+
+  with metrics.stage('get_users_details'):
+    details = resolve_users(run_user_ids(warn_groups, delete_groups))
+    warn_users, bad_users = get_users_details(warn_groups, details)
+  with metrics.stage('keeplist_groups'):
+    keeplist = get_keeplist_members()
+
+  # select warnings and deletions up front, so the whole work list is journalled before anything is sent
+  metrics.start_stage('warn_loop')
   db_session = Session()
+  notification_index = load_notification_index(db_session, [h['id'] for groups in [warn_groups, delete_groups] for uid in groups for h in groups[uid]])
+  to_warn, warn_counts = select_warnings(warn_users, keeplist, notification_index, force, dryrun)
+  metrics.end_stage('warn_loop')
 
-  emailed_users = 0
-  skipped_users = 0
-  error_users = 0
-  emailed_histories = 0
-  skipped_histories = 0
-  processed_users = 0
-  keeplisted_users = 0
-  for user in warn_users:
-    if processed_users % 100 == 0:
-        sys.stdout.write("Warnings processed: " + str(processed_users) + "/" + str(len(warn_users)) + "   \r")
-        sys.stdout.flush()
-    processed_users += 1
+  to_delete = []
+  delete_counts = new_counts()
+  delete_results = (0, 0, 0, 0)
+  if do_delete and len(delete_groups) > 0:
+    with metrics.stage('get_users_details'):
+      delete_users, bad_delete_users = get_users_details(delete_groups, details)
 
-    keeplisted = False
-    if 'groups' in warn_users[user]['details'].keys():
-      for group in warn_users[user]['details']['groups']:
-        if group['name'] == config.GALAXY_KEEPLIST_GROUP:
-          keeplisted = True
+    with metrics.stage('delete_loop'):
+      to_delete, delete_counts = select_deletions(delete_users, keeplist, notification_index, force, dryrun)
 
-    if keeplisted:
-      keeplisted_users += 1
-      continue
+  run_id = None
+  if not dryrun:
+    run_id = start_run_journal(db_session, do_delete, to_warn, to_delete)
 
-    try:
-      username = warn_users[user]['details']['username']
-    except:
-      username = "Galaxy User"
-
-    histories = []
-    for i, h in enumerate(warn_users[user]['histories']):
-      if force or eligible_history(h):
-        del_date = datetime.now()
-
-        first_notification = db_session.query(HistoryNotification).filter_by(h_id=h['id'], h_date=h['update_time']).first()
-        if first_notification is not None:
-          notification = db_session.query(Notification).filter_by(id=first_notification.n_id).first()
-          if notification is None:
-            ## TODO setup error check here. Really shouldn't get here unless there's manual db edits
-            print("Error looking up notifcation. Defaulting to base date.")
-          else:
-            del_date = notification.sent
-        del_date = del_date + timedelta(days=(config.HISTORIES_DELETE_DAYS-config.HISTORIES_WARN_DAYS))
-        h['h_del_time'] = str(del_date.strftime('%Y-%m-%d'))
-        h['h_update_time'] = str(h['update_time'].strftime('%Y-%m-%d'))
-        h['h_size'] = sizeof_fmt(h['size'])
-        histories.append(h)
-        emailed_histories += 1
-      else:
-        skipped_histories += 1
-
-    if len(histories) == 0:
-      # user has no warnable histories. Skip
-      skipped_users += 1
-      continue
-
-    # skip sending code if dryrun
-    if dryrun:
-      continue
-    
-    template_file = config.MAIL_TEMPLATE_WARNING
-    template = Template(open(template_file).read())
-    html = template.render(username = username, histories = histories, warn_weeks = warn_weeks, delete_weeks = delete_weeks, warn_period = str(config.EMAIL_DAYS_THRESHOLD), hist_view_base = GALAXY_HIST_VIEW_BASE)
-
-    notification = Notification()
-    notification.user_id = user
-    notification.type = "Warning"
+  # process warnings
+  with metrics.stage('warn_loop'):
+    warn_results = send_warnings(db_session, to_warn, production, run_id)
 
-    # send the warning email
-    try:
-      email = [warn_users[user]['details']['email']]
-      msg_results = send_email(to=email, html=html, subject=config.MAIL_SUBJECT_WARNING, production=production)
-      notification.sent = datetime.now()
-      notification.status = msg_results['status']
-      if notification.status == "success":
-        notification.message_id = msg_results['data']['message_id']
-        message = Message()
-        message.message_id = msg_results['data']['message_id']
-        message.status = "Accepted"
-        db_session.add(message)
-        notification.message = message
-        emailed_users += 1
-      else:
-        print("ERROR: Postal did not return as success:", msg_results)
-        error_users += 1
+  # Now handle the deletions and deletion emails if required.
+  if do_delete and len(delete_groups) > 0:
+    with metrics.stage('delete_loop'):
+      delete_results = send_deletions(db_session, to_delete, production, run_id)
 
-    except:
-      print("ERROR: Unable to send notification: no email for user:", user)
-      notification.sent = datetime.now()
-      notification.status = "Unable to send"
-      error_users += 1
+  msgs.extend(run_msgs(totals, do_delete, delete_groups, bad_users, bad_delete_users, warn_counts, warn_results, delete_counts, delete_results))
+  finish_run_journal(db_session, run_id)
+  db_session.close()
 
-    db_session.add(notification)
-    db_session.commit()
+  return [warn_users, bad_users, delete_users, bad_delete_users], msgs
 
-    waiting = True
-    num_retries = 0
-    failed = False
-    notification_id = ""
-    while waiting:
-      try:
-        notification_id = notification.id
-        waiting = False
-      except:
-        print(f"Concurrency issue with database. Waiting and retrying.")
-        num_retries += 1
-        sleep(1)
-        if num_retries > 10:
-          print(f"Failed. Skipping.")
-          waiting = False
-          failed = True
-
-    if failed:
-      # TODO add notify here. Hope this doesn't come up
-      continue
+def resume_run(production=False):
+  # Continue the last interrupted warn/delete run on this server from its journal, without scanning histories or
+  # looking users up again. Users whose notification was committed are not emailed again.
+  global GALAXY_BASEURL
+  global Session
+  msgs = []
+  db_session = Session()
+  journal = db_session.query(RunJournal).filter_by(server=GALAXY_BASEURL, status="Running").order_by(RunJournal.id.desc()).first()
+  if journal is None:
+    msg = "No interrupted run to resume."
+    msgs.append(msg)
+    print(msg)
+    db_session.close()
+    return None, msgs
 
-    for h in histories:
-      hn = HistoryNotification()
-      hn.h_id = h['id']
-      hn.h_date = h['update_time']
-      hn.n_id = notification_id
-      db_session.add(hn)
-      db_session.commit()
-
-  msg = f"{emailed_histories} histories eligible for warning, {skipped_histories} histories skipped."
+  to_warn, to_delete, pending_deletions = load_run_journal(db_session, journal)
+  msg = f"Resuming run {journal.id} started {journal.started}: {len(to_warn)} users pending warning, {len(to_delete)} users pending deletion, {len(pending_deletions)} notified histories pending deletion."
   msgs.append(msg)
   print(msg)
 
-  msg = f"{emailed_users} users eligible for warning, {skipped_users} users skipped."
+  with metrics.stage('warn_loop'):
+    emailed_users, error_users = send_warnings(db_session, to_warn, production, journal.id)
+  msg = f"{emailed_users} users warned."
   msgs.append(msg)
   print(msg)
-
-  if keeplisted_users > 0:
-    msg = f"{keeplisted_users} users were excluded due to keeplisting."
-    msgs.append(msg)
-    print(msg)
-
   if error_users > 0:
     msg = f"{error_users} users had error sending warning notification. Check logs/db for more details."
     msgs.append(msg)
     print(msg)
 
-  # Now handle the deletions and deletion emails if required.
-  if do_delete:
-    delete_user_ids = set()
-    for history in delete_histories:
-      delete_user_ids.add(history['user_id'])
-    if len(delete_user_ids) < 1:
-        msg = "No user histories require deletion."
-        msgs.append(msg)
-        print(msg)
-
-        db_session.close()
-        return [warn_users, bad_users, delete_users, bad_delete_users], msgs
-    else:
-        msg = str(len(delete_user_ids)) + " unique users for deletion of " + str(len(delete_histories)) + " histories."
-        msgs.append(msg)
-        print(msg)
-
-    delete_users, bad_delete_users = get_users_details(delete_user_ids, delete_histories)
-
-    if len(bad_delete_users) > 0:
-      msg = str(len(bad_delete_users)) + " delete eligible users without details. Skipping."
+  if journal.do_delete:
+    with metrics.stage('delete_loop'):
+      emailed_users, error_users, deleted_histories, error_histories = send_deletions(db_session, to_delete, production, journal.id, pending_deletions)
+    msg = f"{emailed_users} users notified regarding deletion, {deleted_histories} histories deleted."
+    msgs.append(msg)
+    print(msg)
+    if error_histories > 0:
+      msg = f"{error_histories} failed to be deleted. Check logs/db for more details. Manual intervention required."
+      msgs.append(msg)
+      print(msg)
+    if error_users > 0:
+      msg = f"{error_users} users had error sending deletion notification. Check logs/db for more details."
       msgs.append(msg)
       print(msg)
 
-    emailed_users = 0
-    skipped_users = 0
-    error_users = 0
-    emailed_histories = 0
-    skipped_histories = 0
-    deleted_histories = 0
-    error_histories = 0
-    processed_users = 0
-    keeplisted_users = 0
-    #Craft the html template for the deletion email
-    for user in delete_users:
-      if processed_users % 100 == 0:
-        sys.stdout.write("Deletions processed: " + str(processed_users) + "/" + str(len(delete_users)) + "   \r")
-        sys.stdout.flush()
-      processed_users += 1
+  finish_run_journal(db_session, journal.id)
+  db_session.close()
+  return [to_warn, to_delete], msgs
+
+def journal_user(db_session, run_id, phase, position, job, store_details, refreshed):
+  # Journal one selected user before they are emailed, storing their details first if they came from Galaxy
+  user, username, details, histories = job
+  if store_details:
+    bulk_upsert(db_session, User, [details], values={'refreshed': refreshed})
+  add_journal_entries(db_session, run_id, phase, position, job)
+  db_session.commit()
+
+def store_histories(db_session, groups):
+  history_total = bulk_upsert(db_session, History, (history for histories in groups for uid in histories for history in histories[uid]))
+  db_session.commit()
+  return history_total
+
+def store_users(db_session, users, refreshed):
+  bulk_upsert(db_session, User, users, values={'refreshed': refreshed})
+  db_session.commit()
+
+def run_pipeline(history_pages, dryrun=True, do_delete=False, force=False, production=False):
+  # Does the work of run() as an asyncio pipeline, see run_pipeline_async
+  return asyncio.run(run_pipeline_async(history_pages, dryrun, do_delete, force, production))
+
+async def run_pipeline_async(history_pages, dryrun=True, do_delete=False, force=False, production=False):
+  # Stages connected by bounded queues: the scan hands each new user to the lookup workers as soon as it is seen,
+  # so users are looked up while the scan is still running. Once the scan is classified, each user is selected,
+  # journalled, emailed and recorded as soon as their details arrive, and deletions run alongside. Blocking HTTP
+  # calls run on a thread pool per stage and all database work on a single thread. The counts and messages are
+  # those of run(); emails go out in the same order, but may be recorded in the order they were sent.
+  global Session
+  global NULL_USER_DETAILS
+  loop = asyncio.get_running_loop()
+  msgs = []
+  warn_users = {}
+  bad_users = {}
+  delete_users = {}
+  bad_delete_users = {}
+  user_workers = getattr(config, 'GALAXY_USER_WORKERS', 1)
+  mail_workers = getattr(config, 'MAIL_SEND_WORKERS', 1)
+  delete_workers = getattr(config, 'GALAXY_DELETE_WORKERS', 1)
+  cache_ttl = getattr(config, 'GALAXY_USER_CACHE_HOURS', 0)
+  set_http_pool_size(getattr(config, 'GALAXY_HISTORIES_SCAN_WORKERS', 1) + user_workers + mail_workers + delete_workers)
+  scan_pool = ThreadPoolExecutor(max_workers=1)
+  user_pool = ThreadPoolExecutor(max_workers=user_workers)
+  mail_pool = ThreadPoolExecutor(max_workers=mail_workers)
+  delete_pool = ThreadPoolExecutor(max_workers=delete_workers)
+  db_pool = ThreadPoolExecutor(max_workers=1)
+
+  def db(func, *args):
+    return loop.run_in_executor(db_pool, func, *args)
+
+  db_session = await db(Session)
+  # an HTTP fetch with its own session, so it runs with the user lookups rather than holding up the database thread
+  keeplist_task = loop.run_in_executor(user_pool, get_keeplist_members)
+
+  # user lookups, fed by the scan
+  lookups = asyncio.Queue(maxsize=getattr(config, 'PIPELINE_QUEUE_SIZE', 1000))
+  details = {}
+  fetched = set()
+  seen = set()
+  refreshed = datetime.now()
+
+  async def announce(uids):
+    # Users cached in user_table are read in one query per page of the scan; the rest are queued for Galaxy
+    for uid in uids:
+      details[uid] = loop.create_future()
+    cached = {}
+    if cache_ttl > 0:
+      cached = await db(load_cached_users, db_session, uids, cache_ttl)
+    for uid in uids:
+      if uid in cached:
+        details[uid].set_result(cached[uid])
+      else:
+        await lookups.put(uid)
+
+  def announce_users(pages):
+    # Runs on the scan thread, passing pages on to group_histories and each new user to the lookup stage
+    for page in pages:
+      if page is not None:
+        new_users = []
+        for h in page:
+          if h['user_id'] not in seen:
+            seen.add(h['user_id'])
+            new_users.append(h['user_id'])
+        if new_users:
+          asyncio.run_coroutine_threadsafe(announce(new_users), loop).result()
+      yield page
+
+  async def look_up():
+    while True:
+      uid = await lookups.get()
+      if uid is PIPELINE_END:
+        return
+      user_details = None
+      try:
+        if uid is not None:
+          user_details = await loop.run_in_executor(user_pool, get_user_details, uid)
+          if user_details:
+            fetched.add(uid)
+      except Exception as e:
+        # raised to select() when it reaches this user, as run() would raise it
+        details[uid].set_exception(e)
+        continue
+      details[uid].set_result(user_details)
+
+  try:
+    resolvers = [asyncio.create_task(look_up()) for _ in range(user_workers)]
+    with metrics.stage('classify_histories'):
+      grouped = await loop.run_in_executor(scan_pool, group_histories, announce_users(history_pages), config.HISTORIES_WARN_DAYS, config.HISTORIES_DELETE_DAYS)
+    for _ in resolvers:
+      await lookups.put(PIPELINE_END)
+    if grouped is None:
+      for resolver in resolvers:
+        resolver.cancel()
+      return None, msgs
+    warn_groups, delete_groups, totals = grouped
+    warn_groups, delete_groups = report_groups(warn_groups, delete_groups, totals, do_delete, msgs)
+
+    await db(store_histories, db_session, [warn_groups, delete_groups])
+    notification_index = await db(load_notification_index, db_session, [h['id'] for groups in [warn_groups, delete_groups] for uid in groups for h in groups[uid]])
+    keeplist = await keeplist_task
+    run_id = None
+    if not dryrun:
+      run_id = await db(open_run_journal, db_session, do_delete)
+      get_template(config.MAIL_TEMPLATE_WARNING)
+      if do_delete:
+        get_template(config.MAIL_TEMPLATE_DELETION)
+
+    jobs = asyncio.Queue(maxsize=mail_workers * 2)
+    journalled = set()
+    phases = {
+      "Warning": dict(groups=warn_groups, users=warn_users, bad=bad_users, select=select_user_warnings, send=send_warning,
+        counts=new_counts(), emailed=0, errors=0),
+      "Deletion": dict(groups=delete_groups, users=delete_users, bad=bad_delete_users, select=select_user_deletions, send=send_deletion,
+        counts=new_counts(), emailed=0, errors=0),
+    }
+    deletions = []
+
+    async def select():
+      # In scan order, wait for each user's details and queue those with histories to warn about or delete
+      for phase, stage in phases.items():
+        for position, uid in enumerate(stage['groups']):
+          user = {'histories': stage['groups'][uid]}
+          user_details = await details[uid]
+          if not user_details:
+            user['details'] = NULL_USER_DETAILS
+            stage['bad'][uid] = user
+            continue
+          user['details'] = user_details
+          stage['users'][uid] = user
+
+          job, changes = select_user(uid, user['histories'], user_details, keeplist, stage['select'], notification_index, force, dryrun)
+          add_counts(stage['counts'], changes)
+          if job is None:
+            continue
+          await db(journal_user, db_session, run_id, phase, position, job, uid in fetched and uid not in journalled, refreshed)
+          journalled.add(uid)
+          await jobs.put((phase, job))
+      for _ in range(mail_workers):
+        await jobs.put(PIPELINE_END)
+
+    async def send():
+      # each sent email is recorded before this worker takes the next job, so an interrupted run leaves no sent
+      # email unrecorded other than those in flight on other workers, as with run()
+      while True:
+        item = await jobs.get()
+        if item is PIPELINE_END:
+          return
+        phase, (uid, username, user_details, histories) = item
+        sent, msg_results = await loop.run_in_executor(mail_pool, phases[phase]['send'], item[1], production)
+        accepted = await db(record_user_notification, db_session, run_id, phase, uid, histories, sent, msg_results)
+        if accepted:
+          phases[phase]['emailed'] += 1
+        else:
+          phases[phase]['errors'] += 1
+        if phase == "Deletion":
+          #Actually do the deletion, now that the history notifications are recorded
+          for h in histories:
+            deletions.append((h['id'], delete_pool.submit(remove_history, h['id'], False)))
+
+    with metrics.stage('notify_users'):
+      await asyncio.gather(select(), *resolvers, *[send() for _ in range(mail_workers)])
+      await loop.run_in_executor(None, delete_pool.shutdown)
+      deleted_histories, error_histories = await db(collect_deletions, db_session, run_id, deletions)
+
+    await db(store_users, db_session, [details[uid].result() for uid in fetched if uid not in journalled], refreshed)
+
+    warn, delete = phases["Warning"], phases["Deletion"]
+    msgs.extend(run_msgs(totals, do_delete, delete_groups, bad_users, bad_delete_users, warn['counts'], (warn['emailed'], warn['errors']), \
+      delete['counts'], (delete['emailed'], delete['errors'], deleted_histories, error_histories)))
+
+    await db(finish_run_journal, db_session, run_id)
+    return [warn_users, bad_users, delete_users, bad_delete_users], msgs
+  finally:
+    await db(db_session.close)
+    for pool in [scan_pool, user_pool, mail_pool, delete_pool, db_pool]:
+      pool.shutdown(wait=False)
+
+def shard_of(user_id, shards):
+  # crc32 rather than hash(), which is salted per process, so a user lands on the same shard in every run
+  return zlib.crc32(str(user_id).encode('utf-8')) % shards
+
+def run_shard(shard):
+  # One shard of a --shards run, in a worker process forked by run_sharded with the shards' users and the run
+  # settings in SHARD_WORK. Resolves, selects, emails and deletes for this shard's users only, journalling them
+  # under the coordinator's run, and returns the counts and metrics for run_sharded to merge.
+  global Session
+  work = SHARD_WORK
+  warn_groups, delete_groups = work['groups'][shard]
+
+  # leave the database and HTTP connections inherited from the coordinator to it
+  Session.kw['bind'].dispose(close=False)
+  adapter = requests.adapters.HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE)
+  session.mount('http://', adapter)
+  session.mount('https://', adapter)
+  # the send rate limit applies to all shards together
+  config.MAIL_SEND_RATE = getattr(config, 'MAIL_SEND_RATE', 0) / work['shards']
+  metrics.reset()
+
+  details = resolve_users(run_user_ids(warn_groups, delete_groups))
+  warn_users, bad_users = get_users_details(warn_groups, details)
+  delete_users, bad_delete_users = {}, {}
+  if len(delete_groups) > 0:
+    delete_users, bad_delete_users = get_users_details(delete_groups, details)
+  keeplist = get_keeplist_members()
 
-      keeplisted = False
-      if 'groups' in delete_users[user]['details'].keys():
-        for group in delete_users[user]['details']['groups']:
-          if group['name'] == config.GALAXY_KEEPLIST_GROUP:
-            keeplisted = True
+  db_session = Session()
+  notification_index = load_notification_index(db_session, [h['id'] for groups in [warn_groups, delete_groups] for uid in groups for h in groups[uid]])
+  to_warn, warn_counts = select_warnings(warn_users, keeplist, notification_index, work['force'], work['dryrun'])
+  to_delete, delete_counts = select_deletions(delete_users, keeplist, notification_index, work['force'], work['dryrun'])
+  if work['run_id'] is not None:
+    journal_jobs(db_session, work['run_id'], to_warn, to_delete)
+
+  warn_emailed, warn_errors = send_warnings(db_session, to_warn, work['production'], work['run_id'])
+  delete_results = (0, 0, 0, 0)
+  if len(delete_groups) > 0:
+    delete_results = send_deletions(db_session, to_delete, work['production'], work['run_id'])
+  db_session.close()
 
-      if keeplisted:
-        keeplisted_users += 1
-        continue
+  return {
+    'users': [warn_users, bad_users, delete_users, bad_delete_users],
+    'warn': (warn_counts, warn_emailed, warn_errors),
+    'delete': (delete_counts,) + delete_results,
+    'metrics': metrics.collect(),
+  }
+
+def run_sharded(history_pages, shards, dryrun=True, do_delete=False, force=False, production=False):
+  # Does the work of run() in `shards` worker processes. The histories are scanned and classified here, then each
+  # user is assigned to one shard by shard_of, so no user is handled twice. The shards write to the local database
+  # directly, taking SQLite's write lock in turn (see configure_sqlite), and their counts are merged here into the
+  # usual messages.
+  global Session
+  global SHARD_WORK
+  msgs = []
 
-      try:
-        username = delete_users[user]['details']['username']
-      except:
-        username = "Galaxy User"
-
-      histories = []
-      for i, h in enumerate(delete_users[user]['histories']):
-        if force or eligible_history(h, False): # requires user to have been warned about the history at least once and at least the configured days ago
-          h['h_update_time'] = str(h['update_time'].strftime('%Y-%m-%d'))
-          h['h_size'] = sizeof_fmt(h['size'])
-          histories.append(h)
-          emailed_histories += 1
-        else:
-          skipped_histories += 1
-          # TODO once code is neater, send warning message about such histories here
-          # TODO change order so that the deletion api is called first and then email sent on successful deletion
+  with metrics.stage('classify_histories'):
+    grouped = group_histories(history_pages, config.HISTORIES_WARN_DAYS, config.HISTORIES_DELETE_DAYS)
+  if grouped is None:
+    return None, msgs
+  warn_groups, delete_groups, totals = grouped
+  warn_groups, delete_groups = report_groups(warn_groups, delete_groups, totals, do_delete, msgs)
 
-      if len(histories) == 0:
-        # user has no histories. Skip
-        skipped_users += 1
-        continue
+  groups = [({}, {}) for shard in range(shards)]
+  for i, user_groups in enumerate([warn_groups, delete_groups]):
+    for uid in user_groups:
+      groups[shard_of(uid, shards)][i][uid] = user_groups[uid]
 
-      # skip sending code if dryrun
-      if dryrun:
-        continue
+  # fetched once here, and inherited by the shards
+  with metrics.stage('keeplist_groups'):
+    get_keeplist_members()
 
-      template_file = config.MAIL_TEMPLATE_DELETION
-      template = Template(open(template_file).read())
-      html = template.render(username = username, histories = histories, delete_weeks = delete_weeks, hist_view_base = GALAXY_HIST_VIEW_BASE)
+  db_session = Session()
+  run_id = None
+  if not dryrun:
+    run_id = open_run_journal(db_session, do_delete)
+  db_session.close()
 
-      notification = Notification()
-      notification.user_id = user
-      notification.type = "Deletion"
+  print(f"Processing users in {shards} shards")
+  wait_for_scans()
+  SHARD_WORK = dict(groups=groups, shards=shards, dryrun=dryrun, do_delete=do_delete, force=force, production=production, run_id=run_id)
+  with metrics.stage('shards'):
+    # one single-worker pool per shard: a shard killed outright (OOM, SIGKILL) breaks only its own pool, raising
+    # BrokenProcessPool instead of hanging, while the other shards finish recording what they sent before the
+    # error is raised
+    context = multiprocessing.get_context('fork')
+    pools = [ProcessPoolExecutor(max_workers=1, mp_context=context) for shard in range(shards)]
+    pending = [pool.submit(run_shard, shard) for shard, pool in enumerate(pools)]
+    wait(pending)
+    for pool in pools:
+      pool.shutdown()
+    SHARD_WORK = None
+    results = [result.result() for result in pending]
+
+  users = [{}, {}, {}, {}]
+  warn_counts = new_counts()
+  delete_counts = new_counts()
+  warn_results = [0, 0]
+  delete_results = [0, 0, 0, 0]
+  for result in results:
+    for merged, shard_users in zip(users, result['users']):
+      merged.update(shard_users)
+    counts, *shard_results = result['warn']
+    add_counts(warn_counts, counts)
+    warn_results = [a + b for a, b in zip(warn_results, shard_results)]
+    counts, *shard_results = result['delete']
+    add_counts(delete_counts, counts)
+    delete_results = [a + b for a, b in zip(delete_results, shard_results)]
+    metrics.merge(result['metrics'])
+  warn_users, bad_users, delete_users, bad_delete_users = users
+  msgs.extend(run_msgs(totals, do_delete, delete_groups, bad_users, bad_delete_users, warn_counts, warn_results, delete_counts, delete_results))
 
-      #send the deletion email
-      try:
-        email = [delete_users[user]['details']['email']]
-        msg_results = send_email(to=email, html=html, subject=config.MAIL_SUBJECT_DELETION, production=production)
-        notification.sent = datetime.now()
-        notification.status = msg_results['status']
-        if notification.status == "success":
-          notification.message_id = msg_results['data']['message_id']
-          message = Message()
-          message.message_id = msg_results['data']['message_id']
-          message.status = "Accepted"
-          db_session.add(message)
-          notification.message = message
-          emailed_users += 1
-        else:
-          print("ERROR: Postal did not return as success:", msg_results)
-          error_users += 1
-
-      except:
-        print("ERROR: Unable to send notification: no email for user:", user)
-        notification.sent = datetime.now()
-        notification.status = "Unable to send"
-        error_users += 1
-
-      db_session.add(notification)
-      db_session.commit()
-
-      waiting = True
-      num_retries = 0
-      failed = False
-      notification_id = ""
-      while waiting:
-        try:
-          notification_id = notification.id
-          waiting = False
-        except:
-          print(f"Concurrency issue with database. Waiting and retrying.")
-          num_retries += 1
-          sleep(1)
-          if num_retries > 10:
-            print(f"Failed. Skipping.")
-            waiting = False
-            failed = True
-
-      if failed:
-        # TODO add notify here. Hope this doesn't come up
-        continue
+  db_session = Session()
+  finish_run_journal(db_session, run_id)
+  db_session.close()
+  return users, msgs
 
-      for h in histories:
-        hn = HistoryNotification()
-        hn.h_id = h['id']
-        hn.h_date = h['update_time']
-        hn.n_id = notification_id
-        db_session.add(hn)
-        db_session.commit()
-
-        #Actually do the deletion
-        rem_result = remove_history(h['id'], False)
-        if rem_result:
-          deleted_histories += 1
-        else:
-          error_histories += 1
-          print(f"ERROR: Unable to delete history {h['id']}")
+def set_history_status(db_session, history_ids, status):
+  for i in range(0, len(history_ids), 500):
+    db_session.query(History).filter(History.id.in_(history_ids[i:i+500])).update({History.status: status}, synchronize_session=False)
+  db_session.commit()
 
-    msg = f"{emailed_histories} histories eligible for deletion, {deleted_histories} histories deleted."
-    msgs.append(msg)
-    print(msg)
+def purge_histories(batch_size=500):
+  # Purge every history whose deletion notification is older than PURGE_DAYS_THRESHOLD. Eligible histories come from
+  # one joined query, live status checks and purge requests run on a GALAXY_PURGE_WORKERS pool, and Restored/Purged
+  # statuses are written back in batches.
+  global Session
+  msgs = []
+  num_threshold = 0
+  num_previous = 0
+  num_purged = 0
+  num_error = 0
+  hist_size = 0
+  num_restored = 0
+  workers = getattr(config, 'GALAXY_PURGE_WORKERS', 1)
+  db_session = Session()
 
-    msg = f"{emailed_users} users notified regarding deletion."
-    msgs.append(msg)
-    print(msg)
+  print("Beginning purge of previously deleted histories")
+  warn_threshold = datetime.now() - timedelta(days=config.PURGE_DAYS_THRESHOLD)
+  num_deleted = db_session.query(HistoryNotification).join(Notification, Notification.id == HistoryNotification.n_id) \
+    .filter(Notification.type == "Deletion").count()
+  rows = db_session.query(History.id, History.size, History.status) \
+    .join(HistoryNotification, HistoryNotification.h_id == History.id) \
+    .join(Notification, Notification.id == HistoryNotification.n_id) \
+    .filter(Notification.type == "Deletion", Notification.sent < warn_threshold) \
+    .distinct()
+  # one row per history, even where duplicate Galaxy ids have rows with different statuses; a history any of whose
+  # rows is recorded as purged is not purged again
+  eligible = {}
+  for history in rows:
+    if history.id not in eligible or history.status == "Purged":
+      eligible[history.id] = history
+  eligible = list(eligible.values())
+
+  # histories recorded as purged on a previous run can't come back, so they are not checked again
+  to_check = [history for history in eligible if history.status != "Purged"]
+  num_previous += len(eligible) - len(to_check)
+
+  restored = []
+  purged = []
+  to_purge = []
+  for i, (history, (history_is_deleted, history_is_purged)) in enumerate(zip(to_check, iter_ordered(is_history_deleted_or_purged, to_check, workers))):
+    if i % 100 == 0:
+      sys.stdout.write(f"Histories checked: {i}/{len(to_check)}    \r")
+      sys.stdout.flush()
+
+    if history_is_deleted is None:
+      print(f"Error querying /api/<history_id> for history {history.id}. No action taken")
+      num_error += 1
+    elif history_is_deleted is False:
+      # User has restored history
+      restored.append(history.id)
+      num_restored += 1
+    elif history_is_purged:
+      # User has purged history, or history has taken a long time to purge in a previous week,
+      # resulting in 504 status from delete request
+      purged.append(history.id)
+      num_previous += 1
+    else:
+      to_purge.append(history)
 
-    if keeplisted_users > 0:
-      msg = f"{keeplisted_users} users were excluded due to keeplisting."
-      msgs.append(msg)
-      print(msg)
+    if len(restored) >= batch_size:
+      set_history_status(db_session, restored, "Restored")
+      restored = []
 
-    if error_histories > 0:
-      msg = f"{error_histories} failed to be deleted. Check logs/db for more details. Manual intervention required."
-      msgs.append(msg)
-      print(msg)
+  set_history_status(db_session, restored, "Restored")
+  num_threshold = len(to_purge)
 
-    if skipped_histories > 0:
-      msg = f"{skipped_histories} histories skipped for deletion due to no prior warning notifications, insufficient time between warning and deletion, or failed to be deleted previously. Check logs/db for more details."
-      msgs.append(msg)
-      print(msg)
+  def purge(history):
+    return remove_history(history.id, purge=True)
 
-    if skipped_users > 0:
-      msg = f"{skipped_users} users skipped for notification due to having all skipped histories."
-      msgs.append(msg)
-      print(msg)
+  for i, (history, rem_result) in enumerate(zip(to_purge, iter_ordered(purge, to_purge, workers))):
+    if i % 100 == 0:
+      sys.stdout.write(f"Histories purged/threshold: {num_purged}/{num_threshold}    \r")
+      sys.stdout.flush()
 
-    if error_users > 0:
-      msg = f"{error_users} users had error sending deletion notification. Check logs/db for more details."
-      msgs.append(msg)
-      print(msg)
+    if rem_result:
+      num_purged += 1
+      hist_size += history.size
+      purged.append(history.id)
+    else:
+      num_error += 1
+      print(f"Unable to purge history: {history.id}")
+
+    if len(purged) >= batch_size:
+      set_history_status(db_session, purged, "Purged")
+      purged = []
 
+  set_history_status(db_session, purged, "Purged")
   db_session.close()
 
-  return [warn_users, bad_users, delete_users, bad_delete_users], msgs
+  msgs.append(f"Deleted histories: {num_deleted}")
+  msgs.append(f"Previously purged histories: {num_previous}")
+  msgs.append(f"Eligible histories: {num_threshold}")
+  msgs.append(f"Restored histories: {num_restored}")
+  msgs.append(f"Purged histories: {num_purged}")
+  msgs.append(f"Purged storage: {sizeof_fmt(hist_size)}")
+  msgs.append(f"Errors: {num_error}")
+  for msg in msgs:
+    print(msg)
+  return msgs
 
-def main(dryrun=True, production=False, do_delete=False, force=False, notify=False, drop_db=False, purge=False):
+def db_file_size(engine):
+  # Bytes used by a SQLite local db, including its write-ahead log; None for other databases
+  if engine.dialect.name != 'sqlite' or not engine.url.database:
+    return None
+  return sum(os.path.getsize(path) for path in [engine.url.database, engine.url.database + '-wal'] if os.path.exists(path))
+
+def archive_rows(db_session, archive_session, model, ids, chunk_size=500):
+  # Moves the rows of model with the given primary keys to the archive db. Each chunk is committed there before it is
+  # deleted here. A row whose id is already archived is only deleted if the archived copy is the same, i.e. it was
+  # copied by an interrupted compaction; one that differs (the local db was dropped or restored since) stays here.
+  # SQLite hands the id of a table's newest row out again once that row is deleted, which would clash with its
+  # archived copy, so the newest row always stays. Returns the number of rows moved and the number left for clashing.
+  table = model.__table__
+  key = list(table.primary_key.columns)[0]
+  newest = db_session.query(func.max(key)).scalar()
+  ids = [i for i in ids if i != newest]
+  moved = kept = 0
+  for i in range(0, len(ids), chunk_size):
+    chunk = ids[i:i+chunk_size]
+    rows = {row[key.name]: dict(row) for row in db_session.execute(select(table).where(key.in_(chunk))).mappings()}
+    archived = {row[key.name]: dict(row) for row in archive_session.execute(select(table).where(key.in_(chunk))).mappings()}
+    clashing = [row_id for row_id in rows if row_id in archived and archived[row_id] != rows[row_id]]
+    rows_to_copy = [row for row_id, row in rows.items() if row_id not in archived]
+    if rows_to_copy:
+      archive_session.execute(table.insert(), rows_to_copy)
+    archive_session.commit()
+    done = [row_id for row_id in rows if row_id not in clashing]
+    if done:
+      db_session.execute(table.delete().where(key.in_(done)))
+    db_session.commit()
+    moved += len(done)
+    kept += len(clashing)
+  return moved, kept
+
+def compact_db(archive_uri, batch_size=500):
+  # Moves resolved records from the local db to the archive db, then vacuums and analyzes the local db, so the tables
+  # every run reads only grow with current work. Resolved records are:
+  #   history links of purged histories, and those of warnings, or of deletions of restored histories, sent more
+  #     than ARCHIVE_AFTER_DAYS ago
+  #   notifications left without history links, and messages left without notifications
+  #   purged histories left without links
+  #   run journals other than the newest, unless still running, with their entries
+  global Session
+  msgs = []
+  archive_days = int(getattr(config, 'ARCHIVE_AFTER_DAYS', 365))
+  warned_days = int(config.HISTORIES_DELETE_DAYS) - int(config.HISTORIES_WARN_DAYS)
+  if archive_days <= warned_days:
+    # an archived warning is no longer seen by the deletion run, so its histories would be warned about again
+    print(f"ARCHIVE_AFTER_DAYS ({archive_days}) must be more than HISTORIES_DELETE_DAYS - HISTORIES_WARN_DAYS ({warned_days}). Quiting without any work.")
+    return None
+  engine = Session.kw['bind']
+  archive_engine = create_engine(archive_uri)
+  if archive_engine.dialect.name == 'sqlite':
+    event.listen(archive_engine, 'connect', configure_sqlite)
+  Base.metadata.create_all(archive_engine)
+  db_session = Session()
+  archive_session = sessionmaker(bind=archive_engine)()
+  cutoff = datetime.now() - timedelta(days=archive_days)
+  size_before = db_file_size(engine)
+
+  print("Archiving resolved records to " + archive_uri)
+  links = db_session.query(HistoryNotification.id) \
+    .join(Notification, Notification.id == HistoryNotification.n_id) \
+    .outerjoin(History, History.id == HistoryNotification.h_id) \
+    .filter(or_(History.status == "Purged", and_(Notification.sent < cutoff, or_(Notification.type == "Warning", History.status == "Restored"))))
+  moved_links, kept_links = archive_rows(db_session, archive_session, HistoryNotification, [row.id for row in links], batch_size)
+
+  notifications = db_session.query(Notification.id).filter(~exists().where(HistoryNotification.n_id == Notification.id))
+  moved_notifications, kept_notifications = archive_rows(db_session, archive_session, Notification, [row.id for row in notifications], batch_size)
+
+  messages = db_session.query(Message.id).filter(~exists().where(Notification.message_id == Message.message_id))
+  moved_messages, kept_messages = archive_rows(db_session, archive_session, Message, [row.id for row in messages], batch_size)
+
+  histories = db_session.query(History.hid).filter(History.status == "Purged", ~exists().where(HistoryNotification.h_id == History.id))
+  moved_histories, kept_histories = archive_rows(db_session, archive_session, History, [row.hid for row in histories], batch_size)
+
+  newest_journal = db_session.query(func.max(RunJournal.id)).scalar()
+  journal_ids = [row.id for row in db_session.query(RunJournal.id).filter(RunJournal.status != "Running", RunJournal.id != newest_journal)]
+  entries = []
+  for i in range(0, len(journal_ids), batch_size):
+    entries.extend(row.id for row in db_session.query(RunJournalEntry.id).filter(RunJournalEntry.run_id.in_(journal_ids[i:i+batch_size])))
+  moved_entries, kept_entries = archive_rows(db_session, archive_session, RunJournalEntry, entries, batch_size)
+  moved_journals, kept_journals = archive_rows(db_session, archive_session, RunJournal, journal_ids, batch_size)
+
+  db_session.close()
+  archive_session.close()
+  archive_engine.dispose()
+
+  if engine.dialect.name == 'sqlite':
+    print("Vacuuming and analyzing the local database")
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+      connection.exec_driver_sql("VACUUM")
+      connection.exec_driver_sql("ANALYZE")
+      connection.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+
+  msgs.append(f"Archived history notifications: {moved_links}")
+  msgs.append(f"Archived notifications: {moved_notifications}")
+  msgs.append(f"Archived messages: {moved_messages}")
+  msgs.append(f"Archived purged histories: {moved_histories}")
+  msgs.append(f"Archived run journals: {moved_journals} ({moved_entries} entries)")
+  kept = kept_links + kept_notifications + kept_messages + kept_histories + kept_entries + kept_journals
+  if kept:
+    msgs.append(f"Records left in the local database as the archive holds different records with their ids: {kept}")
+  if size_before is not None:
+    msgs.append(f"Local database size: {sizeof_fmt(size_before)} before, {sizeof_fmt(db_file_size(engine))} after")
+  for msg in msgs:
+    print(msg)
+  return msgs
+
+def configure_sqlite(dbapi_connection, connection_record):
+  # Set on each new connection to a SQLite local db. WAL lets readers carry on while a write commits and, with
+  # synchronous NORMAL, only syncs to disk at checkpoints instead of on every commit. The busy timeout makes a
+  # writer wait for another connection's, e.g. another --shards worker's, write lock instead of failing with
+  # "database is locked".
+  cursor = dbapi_connection.cursor()
+  cursor.execute(f"PRAGMA journal_mode = {getattr(config, 'LOCAL_DB_JOURNAL_MODE', 'WAL')}")
+  cursor.execute(f"PRAGMA synchronous = {getattr(config, 'LOCAL_DB_SYNCHRONOUS', 'NORMAL')}")
+  cursor.execute(f"PRAGMA busy_timeout = {int(getattr(config, 'LOCAL_DB_BUSY_TIMEOUT', 30) * 1000)}")
+  cursor.close()
+
+def main(dryrun=True, production=False, do_delete=False, force=False, notify=False, drop_db=False, purge=False, stream=False, incremental=False, resume=False, pipeline=False, shards=1, compact=False):
   global GALAXY_BASEURL
   global GALAXY_API_KEY
   global GALAXY_HIST_VIEW_BASE
   global db
   global Session
+  global KEEPLIST_MEMBERS
+  global SCAN_MSGS
 
   if notify:
-    notify_slack("Starting Galaxy History Mailer", '\n'.join([f"Dryrun: {dryrun}", "Server: " + ('Production' if production else 'Staging'), f"Deletion: {do_delete}", f"Force Notify: {force}", f"Purge: {purge}"]), 'good')
+    notify_slack("Starting Galaxy History Mailer", '\n'.join([f"Dryrun: {dryrun}", "Server: " + ('Production' if production else 'Staging'), f"Deletion: {do_delete}", f"Force Notify: {force}", f"Purge: {purge}", f"Compact: {compact}"]), 'good')
 
   if production:
     print("Production Galaxy server selected.")
@@ -700,15 +1935,26 @@ def main(dryrun=True, production=False, do_delete=False, force=False, notify=Fal
     GALAXY_API_KEY = config.PROD_GALAXY_API_KEY
     GALAXY_HIST_VIEW_BASE = config.PROD_HIST_VIEW_BASE
     db_uri = config.PROD_LOCAL_DB
+    archive_uri = getattr(config, 'PROD_ARCHIVE_DB', '')
   else:
     print("Staging Galaxy server selected.")
     GALAXY_BASEURL= config.STAGING_GALAXY_BASEURL
     GALAXY_API_KEY = config.STAGING_GALAXY_API_KEY
     GALAXY_HIST_VIEW_BASE = config.STAGING_HIST_VIEW_BASE
     db_uri = config.STAGING_LOCAL_DB
+    archive_uri = getattr(config, 'STAGING_ARCHIVE_DB', '')
 
+  set_render_context()
   engine = create_engine(db_uri)
+  if engine.dialect.name == 'sqlite':
+    event.listen(engine, 'connect', configure_sqlite)
   Session = sessionmaker(bind=engine)
+  KEEPLIST_MEMBERS = None
+  SCAN_MSGS = []
+  metrics.reset()
+  metrics.set_info('mode', 'compact' if compact else 'resume' if resume else 'purge' if purge else 'delete' if do_delete else 'dryrun' if dryrun else 'warn')
+  metrics.set_info('server', 'production' if production else 'staging')
+  event.listen(Session, 'after_commit', lambda db_session: metrics.count('db_commits'))
 
   if drop_db:
     Base.metadata.drop_all(engine)
@@ -716,94 +1962,71 @@ def main(dryrun=True, production=False, do_delete=False, force=False, notify=Fal
     print("Database dropped and recreated")
     return None
 
-  if purge:
-    msgs = []
-    num_deleted = 0
-    num_threshold = 0
-    num_previous = 0
-    num_purged = 0
-    num_error = 0
-    hist_size = 0
-    num_restored = 0
-    db_session = Session()
+  if compact:
+    if not archive_uri:
+      print("No archive database configured. Set " + ('PROD' if production else 'STAGING') + "_ARCHIVE_DB. Quiting without any work.")
+      return None
+    with metrics.stage('compact'):
+      msgs = compact_db(archive_uri)
+    if msgs is None:
+      return None
+    write_metrics(msgs)
+    if notify:
+      notify_slack("Finished Galaxy History Mailer", '\n'.join(msgs), 'good')
+    return None
 
-    print("Beginning purge of previously deleted histories")
-    deletion_notifications = db_session.query(Notification).filter_by(type="Deletion").all()
-    warn_threshold = datetime.now() - timedelta(days=config.PURGE_DAYS_THRESHOLD)
-    deletion_notification_count = 0
-    deletion_notification_total = len(deletion_notifications)
-    processed_histories = 0
-    for deletion_notification in deletion_notifications:
-      history_notifications = db_session.query(HistoryNotification).filter_by(n_id=deletion_notification.id).all()
-      if deletion_notification_count % 100 == 0:
-        sys.stdout.write(f"Delete notifications processsed: {deletion_notification_count}/{deletion_notification_total}  Histories purged/threshold/deleted: {num_purged}/{num_threshold}/{num_deleted}    \r")
-        sys.stdout.flush()
-      deletion_notification_count += 1
-      for history_notification in history_notifications:
-        num_deleted += 1
-        if deletion_notification.sent < warn_threshold:
-          history = db_session.query(History).filter_by(id=history_notification.h_id).first()
-          if history:
-            history_is_deleted, history_is_purged = is_history_deleted_or_purged(history)
-            if history_is_deleted is None:
-              print(f"Error querying /api/<history_id> for history {history.id}. No action taken")
-              num_error += 1
-              continue
-
-            if history_is_deleted is False:
-              # User has restored history
-              history.status = "Restored"
-              db_session.add(history)
-              db_session.commit()
-              num_restored += 1
-              continue
-
-            elif history.status != "Purged":
-              if history_is_purged:
-                # User has purged history, or history has taken a long time to purge in a previous week,
-                # resulting in 504 status from delete request
-                history.status = "Purged"
-                db_session.add(history)
-                db_session.commit()
-                num_previous += 1
-                continue
-              num_threshold += 1
-              rem_result = remove_history(history.id, purge=True)
-              if rem_result:
-                num_purged += 1
-                hist_size += history.size
-                history.status = "Purged"
-                db_session.add(history)
-                db_session.commit()
-              else:
-                num_error += 1
-                print(f"Unable to purge history: {history.id}")
-            else:
-              num_previous += 1
+  if purge:
+    with metrics.stage('purge'):
+      msgs = purge_histories()
+    write_metrics(msgs)
+    if notify:
+      notify_slack("Finished Galaxy History Mailer", '\n'.join(msgs), 'good')
+    return None
 
-    db_session.close()
-    msgs.append(f"Deleted histories: {num_deleted}")
-    msgs.append(f"Previously purged histories: {num_previous}")
-    msgs.append(f"Eligible histories: {num_threshold}")
-    msgs.append(f"Restored histories: {num_restored}")
-    msgs.append(f"Purged histories: {num_purged}")
-    msgs.append(f"Purged storage: {sizeof_fmt(hist_size)}")
-    msgs.append(f"Errors: {num_error}")
-    for msg in msgs:
-      print(msg)
+  if resume:
+    if dryrun:
+      print("A resumed run sends emails and deletes histories, so it can't be a dry run. Quiting without any work.")
+      return None
+    result, msgs = resume_run(production=production)
+    write_metrics(msgs)
     if notify:
       notify_slack("Finished Galaxy History Mailer", '\n'.join(msgs), 'good')
+    return result
+
+  if pipeline and shards > 1:
+    print("--pipeline and --shards can't be combined. Quiting without any work.")
     return None
 
-  histories = get_all_histories(config.HISTORIES_WARN_DAYS)
+  metrics.start_stage('get_all_histories')
+  if incremental:
+    histories = get_incremental_histories(config.HISTORIES_WARN_DAYS)
+    if histories:
+      histories = [histories]
+  elif stream or pipeline:
+    # the scan itself is consumed, and timed, by the classify_histories stage
+    histories = iter_history_batches(config.HISTORIES_WARN_DAYS)
+  else:
+    histories = get_all_histories(config.HISTORIES_WARN_DAYS)
+    if histories:
+      histories = [histories]
+  metrics.end_stage('get_all_histories')
+
   if histories:
-    result, msgs = run(histories, dryrun=dryrun, do_delete=do_delete, force=force, production=production)
+    if shards > 1:
+      result, msgs = run_sharded(histories, shards, dryrun=dryrun, do_delete=do_delete, force=force, production=production)
+    else:
+      engine = run_pipeline if pipeline else run
+      result, msgs = engine(histories, dryrun=dryrun, do_delete=do_delete, force=force, production=production)
+  if histories and result is not None:
+    msgs = SCAN_MSGS + msgs
+    write_metrics(msgs)
     if notify:
       notify_slack("Finished Galaxy History Mailer", '\n'.join(msgs), 'good')
     return result
   else:
     msg = "Unable to fetch histories. Quiting without any work."
     print(msg)
+    write_metrics([msg])
     if notify:
       notify_slack("Error - Galaxy Histroy Mailer", msg, 'danger')
     return None
@@ -829,7 +2052,7 @@ if __name__ == "__main__":
   args = argparser.parse_args()
   if not args.production and not config.STAGING_GALAXY_BASEURL:
     print("No staging URL set. Run with --production flag to use production configuration.")
-  elif args.dryrun or args.warn or args.delete or args.drop_db or args.purge:
-    main(dryrun=args.dryrun, production=args.production, do_delete=args.delete, force=args.force, notify=args.notify, drop_db=args.drop_db, purge=args.purge)
+  elif args.dryrun or args.warn or args.delete or args.drop_db or args.purge or args.resume or args.compact:
+    main(dryrun=args.dryrun, production=args.production, do_delete=args.delete, force=args.force, notify=args.notify, drop_db=args.drop_db, purge=args.purge, stream=args.stream, incremental=args.incremental, resume=args.resume, pipeline=args.pipeline, shards=args.shards, compact=args.compact)
   else:
     print("No run type selected. Quiting without any work. Run with '--help' for usage.")
@@ -0,0 +1,213 @@
+import json, os, resource, threading
+from contextlib import contextmanager
+from time import time
+
+# Upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_lock = threading.Lock()
+stages = {}
+http_requests = {}
+counters = {}
+info = {}
+
+
+# Peak resident memory of the run before the last reset of the kernel's high-water mark
+_run_peak_bytes = 0
+
+
+def reset():
+    global _run_peak_bytes
+    with _lock:
+        stages.clear()
+        http_requests.clear()
+        counters.clear()
+        info.clear()
+        _reset_high_water()
+        _run_peak_bytes = 0
+
+
+def _high_water_bytes():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _reset_high_water():
+    # Writing 5 to clear_refs (Linux) restarts the peak RSS from the current RSS. Where that is not possible the
+    # high-water mark is the process's, so a stage's peak includes earlier stages.
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def _fold_high_water():
+    # Credit the high-water mark since the last reset to the run and to every open stage, then restart it, so each
+    # stage records the peak reached while it was open rather than the peak of the process so far
+    global _run_peak_bytes
+    peak = _high_water_bytes()
+    _run_peak_bytes = max(_run_peak_bytes, peak)
+    for record in stages.values():
+        if 'started' in record:
+            record['max_rss_bytes'] = max(record['max_rss_bytes'], peak)
+    _reset_high_water()
+
+
+def max_rss_bytes():
+    """Peak resident memory of the run, since the last reset()."""
+    return max(_run_peak_bytes, _high_water_bytes())
+
+
+def start_stage(name):
+    with _lock:
+        _fold_high_water()
+        record = stages.setdefault(name, {'seconds': 0.0, 'runs': 0, 'max_rss_bytes': 0})
+        record['started'] = time()
+
+
+def end_stage(name):
+    """Close a stage opened with start_stage. Repeated stages accumulate their wall time and keep their highest peak RSS."""
+    with _lock:
+        _fold_high_water()
+        record = stages[name]
+        record['seconds'] += time() - record.pop('started')
+        record['runs'] += 1
+
+
+@contextmanager
+def stage(name):
+    start_stage(name)
+    try:
+        yield
+    finally:
+        end_stage(name)
+
+
+def observe_request(endpoint, seconds, status_code):
+    with _lock:
+        record = http_requests.get(endpoint)
+        if record is None:
+            record = {'count': 0, 'errors': 0, 'sum': 0.0, 'buckets': [0] * len(LATENCY_BUCKETS)}
+            http_requests[endpoint] = record
+        record['count'] += 1
+        record['sum'] += seconds
+        if status_code != 200:
+            record['errors'] += 1
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                record['buckets'][i] += 1
+
+
+def count(name, amount=1):
+    with _lock:
+        counters[name] = counters.get(name, 0) + amount
+
+
+def set_info(name, value):
+    with _lock:
+        info[name] = value
+
+
+def collect():
+    """The counters and requests of this process, for merge() in the process that started it."""
+    with _lock:
+        return {
+            'counters': dict(counters),
+            'requests': {endpoint: dict(record, buckets=list(record['buckets'])) for endpoint, record in http_requests.items()},
+        }
+
+
+def merge(collected):
+    """Add the counters and requests of a worker process, as returned by its collect(), to this process's."""
+    with _lock:
+        for name, amount in collected['counters'].items():
+            counters[name] = counters.get(name, 0) + amount
+        for endpoint, worker_record in collected['requests'].items():
+            record = http_requests.get(endpoint)
+            if record is None:
+                record = {'count': 0, 'errors': 0, 'sum': 0.0, 'buckets': [0] * len(LATENCY_BUCKETS)}
+                http_requests[endpoint] = record
+            record['count'] += worker_record['count']
+            record['errors'] += worker_record['errors']
+            record['sum'] += worker_record['sum']
+            record['buckets'] = [a + b for a, b in zip(record['buckets'], worker_record['buckets'])]
+
+
+def summary():
+    with _lock:
+        return {
+            'timestamp': time(),
+            'info': dict(info),
+            'stages': {name: dict(record) for name, record in stages.items()},
+            'requests': {endpoint: dict(record, buckets=dict(zip([str(b) for b in LATENCY_BUCKETS], record['buckets'])))
+                         for endpoint, record in http_requests.items()},
+            'counters': dict(counters),
+            'max_rss_bytes': max_rss_bytes(),
+        }
+
+
+def prometheus_text(data):
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f'# HELP history_mailer_{name} {help_text}')
+        lines.append(f'# TYPE history_mailer_{name} {kind}')
+        for labels, value in samples:
+            label_text = ','.join(f'{key}="{val}"' for key, val in labels)
+            lines.append(f'history_mailer_{name}{{{label_text}}} {value}' if label_text else f'history_mailer_{name} {value}')
+
+    metric('last_run_timestamp_seconds', 'gauge', 'Time the last run finished.', [((), data['timestamp'])])
+    metric('max_rss_bytes', 'gauge', 'Peak resident memory of the run.', [((), data['max_rss_bytes'])])
+    metric('stage_seconds', 'gauge', 'Wall time spent in each stage of the last run.',
+           [((('stage', name),), record['seconds']) for name, record in data['stages'].items()])
+    metric('stage_max_rss_bytes', 'gauge', 'Peak resident memory while each stage ran.',
+           [((('stage', name),), record['max_rss_bytes']) for name, record in data['stages'].items()])
+    metric('http_requests_total', 'counter', 'HTTP requests made in the last run.',
+           [((('endpoint', endpoint),), record['count']) for endpoint, record in data['requests'].items()])
+    metric('http_request_errors_total', 'counter', 'HTTP requests that did not return 200 in the last run.',
+           [((('endpoint', endpoint),), record['errors']) for endpoint, record in data['requests'].items()])
+
+    samples = []
+    for endpoint, record in data['requests'].items():
+        for bound, bucket_count in record['buckets'].items():
+            samples.append(((('endpoint', endpoint), ('le', bound)), bucket_count))
+        samples.append(((('endpoint', endpoint), ('le', '+Inf')), record['count']))
+    lines.append('# HELP history_mailer_http_request_duration_seconds HTTP request latency per endpoint.')
+    lines.append('# TYPE history_mailer_http_request_duration_seconds histogram')
+    for labels, value in samples:
+        label_text = ','.join(f'{key}="{val}"' for key, val in labels)
+        lines.append(f'history_mailer_http_request_duration_seconds_bucket{{{label_text}}} {value}')
+    for endpoint, record in data['requests'].items():
+        lines.append(f'history_mailer_http_request_duration_seconds_sum{{endpoint="{endpoint}"}} {record["sum"]}')
+        lines.append(f'history_mailer_http_request_duration_seconds_count{{endpoint="{endpoint}"}} {record["count"]}')
+
+    for name, value in sorted(data['counters'].items()):
+        metric(name + '_total', 'counter', f'{name} in the last run.', [((), value)])
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_atomic(path, text):
+    # textfile collectors may read at any time, so never expose a partially written file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def write(json_file='', prom_file=''):
+    """Write the run summary as JSON and/or a Prometheus textfile collector file. Returns the summary."""
+    data = summary()
+    if json_file:
+        write_atomic(json_file, json.dumps(data, indent=2, default=str) + '\n')
+    if prom_file:
+        write_atomic(prom_file, prometheus_text(data))
+    return data
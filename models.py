@@ -1,8 +1,41 @@
-from sqlalchemy import Column, Integer, String, DateTime, Float, Boolean, ForeignKey
+from itertools import islice
+from sqlalchemy import Column, Integer, String, DateTime, Float, Boolean, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
 Base = declarative_base()
 
 
+def bulk_upsert(session, model, rows, values=None, chunk_size=500):
+    """Insert or update rows (dictionaries from Galaxy) keyed on the Galaxy id.
+
+    Rows are written in chunks of chunk_size with one IN query per chunk to find existing records, all inside the
+    session's current transaction; the caller commits. Only mapped columns present in a row are written and, like
+    update(), the local primary key (uid/hid) is never overwritten. values are set on every row, e.g. a sync_id.
+    """
+    primary_keys = set(column.key for column in model.__mapper__.primary_key)
+    columns = [attr.key for attr in model.__mapper__.column_attrs if attr.key not in primary_keys]
+    rows = iter(rows)
+    count = 0
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return count
+        existing = {m.id: m for m in session.query(model).filter(model.id.in_([row['id'] for row in chunk]))}
+        for row in chunk:
+            fields = {key: row[key] for key in columns if key in row}
+            if values:
+                fields.update(values)
+            m = existing.get(row['id'])
+            if m is None:
+                m = model(fields)
+                session.add(m)
+                existing[row['id']] = m
+            else:
+                for key in fields:
+                    setattr(m, key, fields[key])
+        session.flush()
+        count += len(chunk)
+
+
 class User(Base):
     __tablename__ = "user_table"
 
@@ -15,8 +48,9 @@ class User(Base):
     purged = Column(Boolean, nullable = False)
     quota = Column(String(256), nullable=False)
     email = Column(String(256), nullable=False)
-    id = Column(String(256), nullable=False)
+    id = Column(String(256), nullable=False, unique=True, index=True)
     deleted = Column(Boolean, nullable = False)
+    refreshed = Column(DateTime)  # when the details were last fetched from Galaxy
 
     def __init__(self, dictionary):
         self.__dict__.update(dictionary)
@@ -31,11 +65,14 @@ class User(Base):
 
 class HistoryNotification(Base):
     __tablename__ = 'history_notification_table'
+    __table_args__ = (
+        Index('ix_history_notification_table_history_id_h_date', 'history_id', 'h_date'),
+    )
 
     id = Column(Integer, primary_key=True, nullable=False)
     h_id = Column('history_id', String(256), ForeignKey('history_table.id'), nullable=False)
     h_date = Column(DateTime, nullable=False)
-    n_id = Column('notification_id', Integer, ForeignKey('notification_table.id'), nullable=False)
+    n_id = Column('notification_id', Integer, ForeignKey('notification_table.id'), nullable=False, index=True)
 
 
 class History(Base):
@@ -45,9 +82,10 @@ class History(Base):
     update_time = Column(DateTime, nullable=False)
     size = Column(Float, nullable=False)
     name = Column(String(256), nullable=False)
-    id = Column(String(256), nullable=False)
+    id = Column(String(256), nullable=False, unique=True, index=True)
     user_id = Column(String(256), ForeignKey('user_table.id'), nullable=True)
     status = Column(String(256))
+    sync_id = Column(Integer, index=True)  # Sync that last confirmed this history as a candidate
 
     def __init__(self, dictionary):
         self.__dict__.update(dictionary)
@@ -68,7 +106,7 @@ class Notification(Base):
     message_id = Column(String(256), ForeignKey('message_table.message_id'))
     sent = Column(DateTime, nullable=False)
     status = Column(String(256), nullable=False)
-    type = Column(String(64), nullable=False)
+    type = Column(String(64), nullable=False, index=True)
 
 
 class Message(Base):
@@ -76,4 +114,58 @@ class Message(Base):
 
     id = Column(Integer, primary_key=True, nullable=False)
     message_id = Column(Integer, nullable=False)
-    status = Column(String(256), nullable=False)
\ No newline at end of file
+    status = Column(String(256), nullable=False)
+
+
+class Sync(Base):
+    __tablename__ = "sync_table"
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    server = Column(String(256), nullable=False)
+    scan_time = Column(DateTime, nullable=False)
+    threshold = Column(DateTime, nullable=False)
+    new_histories = Column(Integer, nullable=False)
+    changed_histories = Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return '<History Sync {} {}>'.format(self.server, self.scan_time)
+
+
+class KeeplistMember(Base):
+    __tablename__ = "keeplist_table"
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    server = Column(String(256), nullable=False, index=True)
+    user_id = Column(String(256), nullable=False)
+    fetched = Column(DateTime, nullable=False)
+
+
+class RunJournal(Base):
+    __tablename__ = "run_journal_table"
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    server = Column(String(256), nullable=False, index=True)
+    do_delete = Column(Boolean, nullable=False)
+    started = Column(DateTime, nullable=False)
+    finished = Column(DateTime)
+    status = Column(String(64), nullable=False)  # Running, Complete or Superseded
+
+    def __repr__(self):
+        return '<Run Journal {} {}>'.format(self.server, self.started)
+
+
+class RunJournalEntry(Base):
+    __tablename__ = "run_journal_entry_table"
+    __table_args__ = (
+        Index('ix_run_journal_entry_table_run_id_phase_user_id', 'run_id', 'phase', 'user_id'),
+    )
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    run_id = Column(Integer, ForeignKey('run_journal_table.id'), nullable=False)
+    phase = Column(String(64), nullable=False)  # Warning or Deletion, as Notification.type
+    position = Column(Integer, nullable=False)  # order of the user in the phase
+    user_id = Column(String(256), nullable=False)
+    history_id = Column(String(256), nullable=False)
+    h_date = Column(DateTime, nullable=False)
+    del_date = Column(DateTime)  # deletion date given in a warning
+    status = Column(String(64))  # None until Notified, then Deleted or Failed for deletions